@@ -2,8 +2,12 @@
 Minimal implementation of BPE (Byte Pair Encoding)
 Simple extension of the original code in "Neural Machine Translation of Rare Words with Subword Units"
 """
+import os
 import re
-from collections import defaultdict
+import heapq
+import argparse
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 
 EOW_TOKEN = '</w>'
 def get_initial_words(filename):
@@ -17,9 +21,88 @@ def get_initial_words(filename):
                 segmented_word_to_freq[segmented_word] += 1
     return segmented_word_to_freq
 
+def get_byte_ranges(filenames: list, chunk_size: int):
+    """
+    Splits files into (filename, start, end) byte ranges of about `chunk_size` bytes each.
+    A range doesn't have to end on a line boundary: see `count_words_in_range`.
+    """
+    ranges = []
+    for filename in filenames:
+        size = os.path.getsize(filename)
+        for start in range(0, size, chunk_size):
+            ranges.append((filename, start, min(start + chunk_size, size)))
+    return ranges
+
+def count_words_in_range(byte_range: tuple):
+    """
+    Counts the words of all lines that start in [start, end). The line that crosses `start` belongs to the previous range.
+    """
+    filename, start, end = byte_range
+    word_to_freq = Counter()
+    with open(filename, 'rb') as f:
+        if start > 0:
+            f.seek(start - 1)
+            f.readline() # skip to the first line starting at or after `start`
+        position = f.tell()
+        while position < end:
+            line = f.readline()
+            if not line:
+                break
+            position += len(line)
+            word_to_freq.update(line.decode('utf-8').split())
+    return word_to_freq
+
+def get_initial_words_parallel(filenames: list, num_workers: int = None, chunk_size: int = 2**26):
+    """
+    Same words and counts as `get_initial_words`, for one or many files, counted in a process pool.
+    Returns (word_to_freq, symbols). Each word is stored as a string of symbol ids, one character per symbol:
+    `chr(i)` stands for `symbols[i]`, so "w o r d </w>" becomes "\x03\x07\x01\x09\x00" with `symbols[3] == "w"`.
+    That is the most compact way to hold a sequence of small ints in Python: 1 byte per symbol while there are fewer
+    than 256 symbols, 2 bytes below 65536 (a tuple takes 8 bytes per item plus the int objects).
+    Symbol ids and words are in order of first occurrence in the corpus, like `get_initial_words`, so training on
+    either gives the same vocab and merges.
+    """
+    symbol_to_id = {}
+    word_to_freq = {}
+
+    def add_counts(counts: Counter):
+        for word, freq in counts.items():
+            # words are re-encoded as id strings right away, the parent never holds all the words as text
+            ids = ''.join([chr(symbol_to_id.setdefault(char, len(symbol_to_id))) for char in word])
+            ids += chr(symbol_to_id.setdefault(EOW_TOKEN, len(symbol_to_id)))
+            word_to_freq[ids] = word_to_freq.get(ids, 0) + freq
+
+    max_pending = 2 * (num_workers or os.cpu_count())
+    pending = []
+    with ProcessPoolExecutor(num_workers) as executor:
+        # counters are merged in the order of `ranges`, to keep the corpus order. At most `max_pending` wait in memory
+        for byte_range in get_byte_ranges(filenames, chunk_size):
+            pending.append(executor.submit(count_words_in_range, byte_range))
+            if len(pending) > max_pending:
+                add_counts(pending.pop(0).result())
+        for future in pending:
+            add_counts(future.result())
+    return word_to_freq, list(symbol_to_id)
+
+def to_id_words(word_to_freq: dict):
+    """
+    {"w o r d </w>": 1, ...} -> the (word_to_freq, symbols) format of `get_initial_words_parallel`
+    """
+    symbol_to_id = {}
+    id_words = {}
+    for word, freq in word_to_freq.items():
+        id_words[''.join([chr(symbol_to_id.setdefault(token, len(symbol_to_id))) for token in word.split()])] = freq
+    return id_words, list(symbol_to_id)
+
+def to_segmented_words(word_to_freq: dict, symbols: list):
+    """
+    The format of `get_initial_words_parallel` -> {"w o r d </w>": 1, ...}
+    """
+    return {' '.join([symbols[ord(i)] for i in word]): freq for word, freq in word_to_freq.items()}
+
 def get_tokens(word_to_freq):
     tokens = defaultdict(int)
-    for word in word_to_freq.keys():
+    for word in word_to_freq:
         for token in word.split():
             if token not in tokens:
                 tokens[token] = len(tokens)
@@ -42,24 +125,151 @@ def merge_word_splits(pair, v_in: dict):
         v_out[w_out] = v_in[word]
     return v_out
 
-word_to_freq = get_initial_words('ex_corpus.txt')
-vocab = get_tokens(word_to_freq)
-merges = []
-print("Initial vocab: ", vocab)
-print("##################")
-num_merges = 10
-for i in range(num_merges):
-    pairs = get_stats(word_to_freq)
-    best_pair = max(pairs, key=pairs.get)
-    word_to_freq = merge_word_splits(best_pair, word_to_freq)
-    new_token = ''.join(best_pair)
-    merges.append(best_pair)
-    vocab[new_token] = len(vocab)
-    print(f"Iteration {i+1}")
-    print("Best pair: ", best_pair)
-    print("New token: ", new_token)
-    print("All words: ", list(word_to_freq.keys()))
-    print("##################")
-
-print("Final vocab: ", vocab)
-print("Final list of merges: ", merges)
\ No newline at end of file
+def train(word_to_freq: dict, num_merges: int, verbose: bool = False):
+    """
+    The training loop from the paper: recount all pairs and rewrite all words after every merge.
+    """
+    vocab = get_tokens(word_to_freq)
+    merges = []
+    if verbose:
+        print("Initial vocab: ", vocab)
+        print("##################")
+    for i in range(num_merges):
+        pairs = get_stats(word_to_freq)
+        if not pairs:
+            break # every word is a single token, nothing left to merge
+        best_pair = max(pairs, key=pairs.get)
+        word_to_freq = merge_word_splits(best_pair, word_to_freq)
+        new_token = ''.join(best_pair)
+        merges.append(best_pair)
+        vocab[new_token] = len(vocab)
+        if verbose:
+            print(f"Iteration {i+1}")
+            print("Best pair: ", best_pair)
+            print("New token: ", new_token)
+            print("All words: ", list(word_to_freq.keys()))
+            print("##################")
+    return vocab, merges, word_to_freq
+
+def get_word_pairs(word: str, lengths: list):
+    """
+    Returns {(id, id): (number of occurrences, char offset of the first occurrence)} for one word, as a string of symbol
+    ids. `lengths[i]` is the length of symbol i. Char offsets (unlike positions in the word) don't move when earlier
+    symbols are merged, so they can be compared across merges.
+    """
+    pairs = {}
+    offset = 0
+    for i in range(len(word)-1):
+        pair = (ord(word[i]), ord(word[i+1]))
+        if pair in pairs:
+            pairs[pair] = (pairs[pair][0] + 1, pairs[pair][1])
+        else:
+            pairs[pair] = (1, offset)
+        offset += lengths[pair[0]]
+    return pairs
+
+def train_incremental(word_to_freq: dict, num_merges: int, symbols: list = None):
+    """
+    Same output as `train`, but only the words containing the best pair are touched after each merge.
+
+    Words are strings of symbol ids (see `get_initial_words_parallel`) and pairs are (id, id) tuples. A merge gives the
+    new symbol the next id, and `str.replace` merges all occurrences of a pair left to right in one call, like the
+    regex in `merge_word_splits`.
+    We keep a pair -> count table, a pair -> word indices inverted index and a max-heap of (count, first occurrence, pair).
+    Heap entries are invalidated lazily: an entry is stale if its count doesn't match the table anymore.
+    Ties are broken by the first occurrence of the pair in corpus order (word index, char offset), which is
+    exactly the pair `max(get_stats(...), key=...)` picks, since `get_stats` inserts pairs in that order.
+    If `symbols` is None, `word_to_freq` is in the format of `get_initial_words` and is converted first.
+    """
+    if symbols is None:
+        word_to_freq, symbols = to_id_words(word_to_freq)
+    symbols = list(symbols)
+    symbol_to_id = {symbol: i for i, symbol in enumerate(symbols)}
+    lengths = [len(symbol) for symbol in symbols]
+    vocab = {symbol: i for i, symbol in enumerate(symbols)}
+    words = list(word_to_freq)
+    freqs = list(word_to_freq.values())
+    pair_counts = defaultdict(int)
+    pair_to_words = defaultdict(set)
+    first_seen = {} # pair -> lower bound for (word index, char offset) of its first occurrence
+    for idx, word in enumerate(words):
+        for pair, (n, offset) in get_word_pairs(word, lengths).items():
+            pair_counts[pair] += n * freqs[idx]
+            pair_to_words[pair].add(idx)
+            first_seen.setdefault(pair, (idx, offset))
+    heap = [(-count, first_seen[pair], pair) for pair, count in pair_counts.items()]
+    heapq.heapify(heap)
+
+    merges = []
+    while len(merges) < num_merges and heap:
+        neg_count, key, best_pair = heapq.heappop(heap)
+        if pair_counts.get(best_pair, 0) != -neg_count:
+            continue # stale entry, the count changed after it was pushed
+        # `first_seen` is only a lower bound, since occurrences can disappear. Tighten it and retry if it moved.
+        idx = min(pair_to_words[best_pair])
+        true_key = (idx, get_word_pairs(words[idx], lengths)[best_pair][1])
+        if true_key != key:
+            first_seen[best_pair] = true_key
+            heapq.heappush(heap, (neg_count, true_key, best_pair))
+            continue
+
+        new_token = symbols[best_pair[0]] + symbols[best_pair[1]]
+        if new_token not in symbol_to_id:
+            # different merges can build the same string ("a" + "bc", "ab" + "c"). It is one symbol, as in `train`
+            symbol_to_id[new_token] = len(symbols)
+            symbols.append(new_token)
+            lengths.append(len(new_token))
+        old, new = chr(best_pair[0]) + chr(best_pair[1]), chr(symbol_to_id[new_token])
+        changed = set()
+        for idx in sorted(pair_to_words[best_pair]):
+            old_pairs = get_word_pairs(words[idx], lengths)
+            words[idx] = words[idx].replace(old, new)
+            new_pairs = get_word_pairs(words[idx], lengths)
+            for pair in old_pairs.keys() | new_pairs.keys():
+                old_n = old_pairs[pair][0] if pair in old_pairs else 0
+                new_n = new_pairs[pair][0] if pair in new_pairs else 0
+                if old_n == new_n:
+                    continue
+                pair_counts[pair] += (new_n - old_n) * freqs[idx]
+                changed.add(pair)
+                if new_n == 0:
+                    pair_to_words[pair].discard(idx)
+                else:
+                    pair_to_words[pair].add(idx)
+                    key = (idx, new_pairs[pair][1])
+                    if pair not in first_seen or key < first_seen[pair]:
+                        first_seen[pair] = key
+        for pair in changed:
+            if pair_counts[pair] > 0:
+                heapq.heappush(heap, (-pair_counts[pair], first_seen[pair], pair))
+            else:
+                del pair_counts[pair], pair_to_words[pair], first_seen[pair]
+
+        merges.append((symbols[best_pair[0]], symbols[best_pair[1]]))
+        vocab[new_token] = len(vocab)
+    word_to_freq = {' '.join([symbols[ord(i)] for i in word]): freq for word, freq in zip(words, freqs)}
+    return vocab, merges, word_to_freq
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--corpus", type=str, nargs="+", default=["ex_corpus.txt"])
+parser.add_argument("--num_merges", type=int, default=10)
+parser.add_argument("--incremental", action="store_true", help="Use the incremental trainer. Recommended for large corpora")
+parser.add_argument("--num_workers", type=int, default=0, help="Count words with this many processes (0: read the corpus in this process)")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.num_workers > 0:
+        word_to_freq, symbols = get_initial_words_parallel(args.corpus, args.num_workers)
+        if not args.incremental:
+            word_to_freq, symbols = to_segmented_words(word_to_freq, symbols), None
+    else:
+        word_to_freq, symbols = defaultdict(int), None
+        for filename in args.corpus:
+            for word, freq in get_initial_words(filename).items():
+                word_to_freq[word] += freq
+    if args.incremental:
+        vocab, merges, word_to_freq = train_incremental(word_to_freq, args.num_merges, symbols)
+    else:
+        vocab, merges, word_to_freq = train(word_to_freq, args.num_merges, verbose=True)
+    print("Final vocab: ", vocab)
+    print("Final list of merges: ", merges)
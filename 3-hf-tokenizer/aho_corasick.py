@@ -0,0 +1,119 @@
+"""
+Aho-Corasick automaton for splitting text on added tokens. Drop-in replacement for HF's `Trie` (`add`, `split`, `_tokens`).
+
+HF's `Trie.split` walks the text one character at a time while keeping a dict of live partial matches, so its cost
+grows with the number of added tokens. Here, all tokens are compiled into one automaton with failure links, so each
+character is a single transition. Characters that can't start a token are skipped with a regex search.
+"""
+from typing import List
+import regex as re
+
+
+class AhoCorasickSplitter:
+    """
+    Splits text at the boundaries of added tokens, preferring the leftmost match and then the longest one
+    (same as `Trie.split`). The automaton is rebuilt lazily on the first `split` after tokens are added.
+    """
+    def __init__(self, *args):
+        self._tokens = set()
+        self._dirty = False
+        self.goto = [{}] # state -> {char: next state}. State 0 is the root
+        self.fail = [0] # failure link: longest proper suffix of the state's string that is also a token prefix
+        self.depth = [0] # length of the state's string
+        self.out = [0] # length of the longest token that is a suffix of the state's string (0 if none)
+        self.first_chars = None # regex matching any character that starts a token
+        for word in args:
+            self.add(word)
+
+    def add(self, word: str):
+        """
+        Adds a word. Like HF's `Trie.add`, adding an empty or existing word does nothing.
+        """
+        if not word or word in self._tokens:
+            return
+        self._tokens.add(word)
+        self._dirty = True
+
+    def build(self):
+        """
+        Builds the trie of tokens, then the failure links in breadth-first order.
+        """
+        goto, depth, out = [{}], [0], [0]
+        for token in self._tokens:
+            state = 0
+            for char in token:
+                next_state = goto[state].get(char)
+                if next_state is None:
+                    next_state = len(goto)
+                    goto[state][char] = next_state
+                    goto.append({})
+                    depth.append(depth[state] + 1)
+                    out.append(0)
+                state = next_state
+            out[state] = len(token)
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())
+        for state in queue: # `queue` grows while we iterate over it
+            for char, child in goto[state].items():
+                link = fail[state]
+                while link and char not in goto[link]:
+                    link = fail[link]
+                fail[child] = goto[link].get(char, 0)
+                if not out[child]:
+                    out[child] = out[fail[child]]
+                queue.append(child)
+        self.goto, self.fail, self.depth, self.out = goto, fail, depth, out
+        self.first_chars = re.compile("[" + "".join(re.escape(char) for char in goto[0]) + "]") if goto[0] else None
+        self._dirty = False
+
+    def split(self, text: str) -> List[str]:
+        """
+        Splits `text` into chunks at the boundaries of added tokens.
+        Ex: "This is<|endoftext|> fine" -> ["This is", "<|endoftext|>", " fine"]
+        """
+        if self._dirty:
+            self.build()
+        if self.first_chars is None:
+            return [text] if text else []
+        goto, fail, depth, out = self.goto, self.fail, self.depth, self.out
+        matches = []
+        best = None # (start, end) of the best match found so far, not committed yet
+        i, state = 0, 0
+        n = len(text)
+        while True:
+            # commit the best match once no live partial match starts at or before it
+            if best is not None and (i >= n or i - depth[state] > best[0]):
+                matches.append(best)
+                i, state, best = best[1], 0, None
+                continue
+            if i >= n:
+                break
+            if state == 0:
+                # fast path: jump to the next character that can start a token
+                match = self.first_chars.search(text, i)
+                if match is None:
+                    break
+                i = match.start()
+            char = text[i]
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            i += 1
+            if out[state]:
+                start = i - out[state]
+                if best is None or start <= best[0]:
+                    best = (start, i)
+        # cut the text at the match boundaries
+        chunks = []
+        previous_end = 0
+        for start, end in matches:
+            if start > previous_end:
+                chunks.append(text[previous_end:start])
+            chunks.append(text[start:end])
+            previous_end = end
+        if previous_end < n:
+            chunks.append(text[previous_end:])
+        return chunks
+
+    def __repr__(self) -> str:
+        return f"AhoCorasickSplitter(num_tokens={len(self._tokens)})"
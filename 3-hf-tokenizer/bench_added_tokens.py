@@ -0,0 +1,50 @@
+"""
+Benchmark for splitting text on added tokens: HF's `Trie` vs `AhoCorasickSplitter`, with 10, 1k and 50k added tokens.
+Two kinds of vocabularies: only special tokens ("<|extra_12|>"), and half special tokens, half domain words ("zylophrenic").
+Example: python bench_added_tokens.py --file README.md --sizes 10 1000 50000
+"""
+import argparse
+import itertools
+import random
+import time
+from minimal_hf_tok import MyTrie
+from aho_corasick import AhoCorasickSplitter
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--file", type=str, default="README.md")
+parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 50000])
+parser.add_argument("--seed", type=int, default=0)
+
+
+def make_tokens(num_tokens: int, kind: str, rng: random.Random):
+    tokens = [f"<|extra_{i}|>" for i in range(num_tokens if kind == "special" else num_tokens // 2)]
+    while len(tokens) < num_tokens:
+        tokens.append("".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(8, 14))))
+    return tokens
+
+
+def time_split(splitter, lines):
+    start = time.perf_counter()
+    chunks = [splitter.split(line) for line in lines]
+    return time.perf_counter() - start, chunks
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    with open(args.file, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    print(f"{len(lines)} lines, {sum(len(line) for line in lines)} characters")
+    print(f"{'num tokens':>10} {'kind':>8} {'trie (s)':>10} {'aho-corasick (s)':>17} {'speedup':>8} {'same output':>12}")
+    for size, kind in itertools.product(args.sizes, ["special", "mixed"]):
+        tokens = make_tokens(size, kind, rng)
+        # sprinkle some of the added tokens in the text
+        text = [line + rng.choice(tokens) if rng.random() < 0.3 else line for line in lines]
+        trie, aho_corasick = MyTrie(), AhoCorasickSplitter()
+        for token in tokens:
+            trie.add(token)
+            aho_corasick.add(token)
+        aho_corasick.build() # so that building the automaton isn't counted, like the trie which is built in `add`
+        trie_time, trie_chunks = time_split(trie, text)
+        aho_corasick_time, aho_corasick_chunks = time_split(aho_corasick, text)
+        print(f"{size:>10} {kind:>8} {trie_time:10.3f} {aho_corasick_time:17.3f} {trie_time / aho_corasick_time:8.1f} {str(trie_chunks == aho_corasick_chunks):>12}")
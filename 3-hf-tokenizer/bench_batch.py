@@ -0,0 +1,40 @@
+"""
+Throughput scaling of `MySlowTokenizer.encode_batch` from 1 to N workers.
+Example: python bench_batch.py --file ../README.md --repeat 200 --max_workers 8
+"""
+import argparse
+import os
+import time
+from minimal_hf_tok import MySlowTokenizer
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--vocab_file", type=str, default="vocab.json")
+parser.add_argument("--file", type=str, default="README.md", help="Each paragraph of this file is a document")
+parser.add_argument("--repeat", type=int, default=50, help="Number of times to repeat the documents")
+parser.add_argument("--backend", type=str, default="process", choices=["thread", "process"])
+parser.add_argument("--max_workers", type=int, default=os.cpu_count())
+parser.add_argument("--chunk_size", type=int, default=None)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    with open(args.file, "r", encoding="utf-8") as f:
+        docs = [doc for doc in f.read().split("\n\n") if doc] * args.repeat
+    num_bytes = sum(len(doc.encode("utf-8")) for doc in docs)
+    tokenizer = MySlowTokenizer(args.vocab_file)
+    # serial baseline. The cache is cleared so that every run starts cold
+    tokenizer.cache.clear()
+    start = time.perf_counter()
+    expected = tokenizer.encode_batch(docs)
+    serial_time = time.perf_counter() - start
+    print(f"{len(docs)} documents, {num_bytes / 1e6:.1f} MB, {sum(len(ids) for ids in expected)} tokens")
+    print(f"{'workers':>8} {'seconds':>8} {'docs/s':>10} {'MB/s':>8} {'speedup':>8}")
+    print(f"{'serial':>8} {serial_time:8.2f} {len(docs) / serial_time:10.0f} {num_bytes / 1e6 / serial_time:8.2f} {1:8.2f}")
+    for num_workers in range(1, args.max_workers + 1):
+        # warm up the pool so that worker startup (loading the vocab) isn't counted
+        tokenizer.encode_batch(docs[:num_workers], backend=args.backend, num_workers=num_workers)
+        start = time.perf_counter()
+        output = tokenizer.encode_batch(docs, backend=args.backend, num_workers=num_workers, chunk_size=args.chunk_size)
+        elapsed = time.perf_counter() - start
+        assert output == expected, "batch encoding doesn't match serial encoding"
+        print(f"{num_workers:>8} {elapsed:8.2f} {len(docs) / elapsed:10.0f} {num_bytes / 1e6 / elapsed:8.2f} {serial_time / elapsed:8.2f}")
+    tokenizer.close()
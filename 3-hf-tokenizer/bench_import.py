@@ -0,0 +1,45 @@
+"""
+Cold import time of the tokenizer modules. Every measurement runs in a fresh interpreter, like a CLI call or a new
+worker would. `bpe` and `minimal_hf_tok` only need the standard library and `regex`: `transformers` is imported
+on demand by the HF comparison code, and this benchmark fails if it gets imported anyway.
+Example: python bench_import.py --repeats 10
+"""
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start, "transformers" in sys.modules)
+"""
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--modules", type=str, nargs="+", default=["bpe", "minimal_hf_tok"])
+parser.add_argument("--repeats", type=int, default=10)
+parser.add_argument("--budget_ms", type=float, default=100, help="Fail if the median import time is above this")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    print(f"{'module':>16} {'min (ms)':>9} {'median (ms)':>12} {'process (ms)':>13}")
+    over_budget = []
+    for module in args.modules:
+        import_times, process_times = [], []
+        for _ in range(args.repeats):
+            # wall time of the whole process too, which includes starting the interpreter
+            start = time.perf_counter()
+            output = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT.format(module=module)], capture_output=True, text=True, check=True)
+            process_times.append((time.perf_counter() - start) * 1000)
+            import_time, imported_transformers = output.stdout.split()
+            if imported_transformers == "True":
+                raise RuntimeError(f"importing {module} imports transformers")
+            import_times.append(float(import_time) * 1000)
+        median = statistics.median(import_times)
+        print(f"{module:>16} {min(import_times):9.1f} {median:12.1f} {statistics.median(process_times):13.1f}")
+        if median > args.budget_ms:
+            over_budget.append(module)
+    if over_budget:
+        sys.exit(f"Over the {args.budget_ms:.0f}ms budget: {over_budget}")
@@ -0,0 +1,76 @@
+"""
+Incremental re-tokenization of edited documents with `EditableEncoding`, compared with running `encode` on the whole
+text after every edit. Random edits (typing, deletions, pasted text with whitespace runs, non-ASCII characters and
+added tokens) are checked against a full `encode`, then both are timed for documents of growing size.
+Example: python bench_incremental.py --num_edits 500 --sizes 1 10 100
+"""
+import argparse
+import random
+import time
+from minimal_hf_tok import EOS_TOKEN, MySlowTokenizer
+
+SNIPPETS = ["a", "e", " ", "  ", "\n", "\n\n", "\t", "the", " word", "'s", "don't", "42", "!!", "é", "🤗", "中文", EOS_TOKEN, "<|end", "oftext|>"]
+
+
+def random_edit(rng: random.Random, text: str):
+    """
+    (begin, end, replacement): mostly single character edits, sometimes deletions or pasted snippets.
+    """
+    begin = rng.randint(0, len(text))
+    kind = rng.random()
+    if kind < 0.5:
+        return begin, begin, rng.choice(SNIPPETS)[:1] # typing
+    if kind < 0.7:
+        return begin, min(len(text), begin + rng.randint(1, 10)), "" # deletion
+    end = min(len(text), begin + rng.randint(0, 20))
+    return begin, end, "".join(rng.choice(SNIPPETS) for _ in range(rng.randint(1, 8))) # replacement
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--vocab_file", type=str, default="vocab.json")
+parser.add_argument("--file", type=str, default="README.md", help="Document to edit")
+parser.add_argument("--num_edits", type=int, default=300)
+parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 50], help="Document sizes, as copies of --file")
+parser.add_argument("--seed", type=int, default=0)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    tokenizer = MySlowTokenizer(args.vocab_file)
+    tokenizer.add_tokens("<|mytoken|>")
+    SNIPPETS.append("<|mytoken|>")
+    with open(args.file, "r", encoding="utf-8") as f:
+        base_text = f.read()
+    rng = random.Random(args.seed)
+    # correctness: every edit, on small documents so that edits often reach the start and the end
+    for text in ["", "a", base_text[:300], base_text[:3000]]:
+        encoding = tokenizer.editable_encoding(text)
+        for _ in range(args.num_edits):
+            begin, end, replacement = random_edit(rng, encoding.text)
+            encoding.edit(begin, end, replacement)
+            assert encoding.ids == tokenizer.encode(encoding.text), f"ids differ after replacing [{begin}:{end}] with {replacement!r}"
+            assert [start for start, _, _ in tokenizer._split_with_offsets(encoding.text)] == encoding.starts, "piece boundaries differ"
+    print(f"Incremental ids match a full encode after {4 * args.num_edits} random edits")
+
+    print(f"{'size (chars)':>12} {'encode (ms/edit)':>17} {'incremental (ms/edit)':>22} {'speedup':>8}")
+    for size in args.sizes:
+        text = base_text * size
+        encoding = tokenizer.editable_encoding(text) # also warms up the word cache
+        edits = []
+        for _ in range(args.num_edits):
+            edits.append(random_edit(rng, text))
+            begin, end, replacement = edits[-1]
+            text = text[:begin] + replacement + text[end:]
+        # full re-encoding on a sample of the edits, it gets slow for big documents
+        sample = edits[:max(1, args.num_edits // size)]
+        start = time.perf_counter()
+        full_text = encoding.text
+        for begin, end, replacement in sample:
+            full_text = full_text[:begin] + replacement + full_text[end:]
+            tokenizer.encode(full_text)
+        full_time = (time.perf_counter() - start) / len(sample)
+        start = time.perf_counter()
+        for begin, end, replacement in edits:
+            encoding.edit(begin, end, replacement)
+        incremental_time = (time.perf_counter() - start) / len(edits)
+        assert encoding.ids == tokenizer.encode(encoding.text)
+        print(f"{len(text):12d} {full_time * 1000:17.2f} {incremental_time * 1000:22.3f} {full_time / incremental_time:8.0f}x")
@@ -2,11 +2,12 @@
 A simple BPE tokenizer implementation
 """
 import json
-from typing import Any
+import heapq
+from typing import Any, List
 import regex as re # regex is cooler than re
 import warnings
 import os
-from transformers.models.gpt2.tokenization_gpt2 import bytes_to_unicode
+from compiled_tokenizer import CompiledTokenizer, MappedVocab, MappedIdToToken, is_compiled_tokenizer
 
 # a hacky custom warning formatter to avoid full path being shown
 def custom_formatwarning(msg, category, filename, lineno, line=None):
@@ -16,6 +17,22 @@ def custom_formatwarning(msg, category, filename, lineno, line=None):
 
 warnings.formatwarning = custom_formatwarning
 
+def bytes_to_unicode():
+    """
+    Maps every byte to a printable unicode character, so that BPE works on strings without whitespace/control characters.
+    Printable bytes map to themselves, the others to chr(256), chr(257), ... (ex: the space byte becomes "Ġ").
+    Same as HF's `bytes_to_unicode` in the GPT-2 tokenizer, copied so that importing this module doesn't need `transformers`.
+    """
+    bs = list(range(ord("!"), ord("~") + 1)) + list(range(ord("¡"), ord("¬") + 1)) + list(range(ord("®"), ord("ÿ") + 1))
+    cs = bs[:]
+    n = 0
+    for b in range(2**8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2**8 + n)
+            n += 1
+    return dict(zip(bs, [chr(c) for c in cs]))
+
 def get_pairs(word):
     """
     Return set of symbol pairs in a word.
@@ -30,15 +47,27 @@ def get_pairs(word):
         prev_char = char
     return pairs
 
+MERGE_ENGINES = ("loop", "heap")
+LAZY_ATTRIBUTES = ("merges", "bpe_ranks", "byte_ids", "merge_table")
+
 class BPE:
-    def __init__(self, vocab_file: str):
-        self.token_to_id = {} # vocab. Called `encoder` in `GPT2Tokenizer`
-        self.id_to_token = {} # called `decoder` in `GPT2Tokenizer`
-        self.merges = []
-        self.bpe_ranks = dict()
+    def __init__(self, vocab_file: str, merge_engine: str = "loop"):
+        if merge_engine not in MERGE_ENGINES:
+            raise ValueError(f"merge_engine should be one of {MERGE_ENGINES}, got {merge_engine}")
+        self.merge_engine = merge_engine # "loop" is the HF implementation, "heap" is faster for long words
         self.byte_encoder = bytes_to_unicode() # maps bytes to unicode strings
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        self.load_vocab(vocab_file)
+        self.compiled = None # set if loaded from a compiled (binary) tokenizer file
+        if is_compiled_tokenizer(vocab_file):
+            self.load_compiled(vocab_file)
+        else:
+            self.token_to_id = {} # vocab. Called `encoder` in `GPT2Tokenizer`
+            self.id_to_token = {} # called `decoder` in `GPT2Tokenizer`
+            self.merges = []
+            self.bpe_ranks = dict()
+            self.byte_ids = [] # byte -> id of its (single character) token. These are the seed ids for merging
+            self.merge_table = dict() # (left_id, right_id) -> (rank, merged_id). Integer version of `bpe_ranks`
+            self.load_vocab(vocab_file)
     
     def load_vocab(self, vocab_file: str):
         with open(vocab_file, 'r') as f:
@@ -50,11 +79,70 @@ class BPE:
             pair = tuple(merge.split()) # merge is repr as "a b". Works because we split on whitespace in pre-tok step
             # i is the index of the merge in the merges list, also the rank. lower rank means merge happens earlier
             self.bpe_ranks[pair] = i 
-        
+        self.compile_merges()
+
+    def load_compiled(self, path: str):
+        """
+        Loads a tokenizer compiled with `compiled_tokenizer.py`. The file is memory-mapped: the vocab is looked up
+        in place, and the other attributes (`merge_table`, `bpe_ranks`, ...) are only built when first used.
+        """
+        self.compiled = CompiledTokenizer(path)
+        self.token_to_id = MappedVocab(self.compiled)
+        self.id_to_token = MappedIdToToken(self.compiled)
+
+    def __getattr__(self, name: str) -> Any:
+        # only called for attributes that aren't set yet, i.e. the lazy attributes of a compiled tokenizer
+        compiled = self.__dict__.get("compiled")
+        if compiled is None or name not in LAZY_ATTRIBUTES:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        if name == "byte_ids":
+            value = [self.token_to_id[self.byte_encoder[b]] for b in range(256)]
+        else:
+            value = getattr(compiled, f"build_{name}")()
+        setattr(self, name, value)
+        return value
+
+    def compile_merges(self):
+        """
+        Precompiles the merges into an integer table, so that encoding never has to touch strings.
+        """
+        self.byte_ids = [self.token_to_id[self.byte_encoder[b]] for b in range(256)]
+        self.merge_table = {}
+        for (first, second), rank in self.bpe_ranks.items():
+            merged_id = self.token_to_id.get(first + second)
+            if merged_id is None:
+                continue # merged token isn't in the vocab (ex: a shrunk vocab), so this merge can never be used
+            self.merge_table[(self.token_to_id[first], self.token_to_id[second])] = (rank, merged_id)
+
+    def encode_bytes(self, word: bytes) -> List[int]:
+        """
+        Tokenizes a utf-8 encoded word and returns token ids. Same result as `__call__` + vocab lookup, but runs on ints.
+        """
+        ids = [self.byte_ids[b] for b in word]
+        if self.merge_engine == "heap":
+            return self._merge_ids_heap(ids)
+        return self._merge_ids_loop(ids)
+
     def __call__(self, word: str, dont_byte_encode: bool = False) -> Any:
         if " " in word and not dont_byte_encode:
             warnings.warn("Word contains whitespaces. Encoding to unicode strings...")
-            word = "".join([self.byte_encoder[b] for b in word.encode("utf-8")])
+            # latin-1 maps each byte to the code point with the same value, so `byte_encoder` works as a translate table
+            word = word.encode("utf-8").decode("latin-1").translate(self.byte_encoder)
+        if self.merge_engine == "heap" and all(c in self.token_to_id for c in word):
+            word = [self.id_to_token[i] for i in self._merge_ids_heap([self.token_to_id[c] for c in word])]
+        else:
+            # characters outside of the vocab (a word that wasn't byte-encoded, ex: "中文") have no id: the loop
+            # works on strings, and keeps them as they are
+            word = self._merge_loop(word)
+        word = " ".join(word)
+        return word
+
+    def _merge_loop(self, word: str) -> tuple:
+        """
+        Merge loop from HF's GPT-2 tokenizer. Finds the lowest rank pair, merges all its occurrences and repeats.
+        """
+        if len(word) < 2:
+            return tuple(word)
         pairs = get_pairs(word) # "obobc" -> set([("o", "b"), ("b", "o"), ("b", "c")])
         while True:
             # get pair of chars/tokens with lowest rank and merge
@@ -86,8 +174,79 @@ class BPE:
                 break
             else:
                 pairs = get_pairs(word)
-        word = " ".join(word)
-        return word
+        return tuple(word)
+
+    def _merge_ids_loop(self, ids: List[int]) -> List[int]:
+        """
+        `_merge_loop` on token ids: find the lowest rank pair, merge all its occurrences and repeat.
+        """
+        merge_table = self.merge_table
+        while len(ids) > 1:
+            best = None
+            for pair in zip(ids, ids[1:]):
+                merge = merge_table.get(pair)
+                if merge is not None and (best is None or merge[0] < best[0]):
+                    best, first, second = merge, pair[0], pair[1]
+            if best is None:
+                break
+            merged_id = best[1]
+            new_ids = []
+            i = 0
+            while i < len(ids):
+                if ids[i] == first and i < len(ids) - 1 and ids[i + 1] == second:
+                    new_ids.append(merged_id)
+                    i += 2
+                else:
+                    new_ids.append(ids[i])
+                    i += 1
+            ids = new_ids
+        return ids
+
+    def _merge_ids_heap(self, ids: List[int]) -> List[int]:
+        """
+        Same merges as `_merge_ids_loop`, in O(n log n) for a word with n symbols.
+
+        Symbols live in a doubly linked array (a merged symbol stays at the index of its left half), and candidate
+        pairs sit in a heap ordered by (rank, index). Entries are invalidated lazily: an entry is stale if the
+        symbols at its indices are no longer neighbours or have changed. All occurrences of the lowest rank are
+        merged left to right before any newly created pair is looked at, just like one iteration of the loop.
+        """
+        merge_table = self.merge_table
+        symbols = list(ids)
+        n = len(symbols)
+        prev = list(range(-1, n - 1))
+        nxt = list(range(1, n + 1)) # n marks the end of the word
+        heap = []
+        for i in range(n - 1):
+            merge = merge_table.get((symbols[i], symbols[i + 1]))
+            if merge is not None:
+                heap.append((merge[0], i, symbols[i], symbols[i + 1], merge[1]))
+        heapq.heapify(heap)
+        while heap:
+            rank = heap[0][0]
+            # collect every occurrence of the lowest rank pair, in left to right order
+            wave = []
+            while heap and heap[0][0] == rank:
+                wave.append(heapq.heappop(heap))
+            wave.sort(key=lambda entry: entry[1])
+            for _, i, first, second, merged_id in wave:
+                j = nxt[i]
+                if symbols[i] != first or j >= n or symbols[j] != second:
+                    continue # stale: one of the two symbols was merged away
+                symbols[i] = merged_id
+                symbols[j] = None
+                nxt[i] = nxt[j]
+                if nxt[j] < n:
+                    prev[nxt[j]] = i
+                # new candidate pairs with the left and right neighbours
+                for left in (prev[i], i):
+                    right = nxt[left] if left >= 0 else n
+                    if left < 0 or right >= n:
+                        continue
+                    merge = merge_table.get((symbols[left], symbols[right]))
+                    if merge is not None:
+                        heapq.heappush(heap, (merge[0], left, symbols[left], symbols[right], merge[1]))
+        return [symbol for symbol in symbols if symbol is not None]
 
     def __repr__(self) -> str:
         return f"BPE(vocab_size={len(self.token_to_id)})"
@@ -100,9 +259,18 @@ class BPE:
     
 
 if __name__ == "__main__":
-
-    bpe = BPE("vocab.json")
-    from transformers import AutoTokenizer
-    gpt2 = AutoTokenizer.from_pretrained("gpt2", use_fast=False)
-    gpt2.encode(" worda")
-    import pdb; pdb.set_trace()
\ No newline at end of file
+    # Checks that both merge engines give the same tokens, on byte-encoded words and on words with characters that
+    # aren't in the vocab
+    import random
+    loop, heap = BPE("vocab.json"), BPE("vocab.json", merge_engine="heap")
+    with open("README.md", "r", encoding="utf-8") as f:
+        words = f.read().split()
+    rng = random.Random(0)
+    words += ["中文", "é", "naïve", "🤗🤗", "a中b", "", "x"]
+    words += ["".join(rng.choice(words[:500]) for _ in range(rng.randint(2, 50))) for _ in range(200)] # long words
+    for word in words:
+        byte_encoded = word.encode("utf-8").decode("latin-1").translate(loop.byte_encoder)
+        for text in (word, byte_encoded):
+            assert loop(text, dont_byte_encode=True) == heap(text, dont_byte_encode=True), f"merge engines differ on {text!r}"
+        assert loop.encode_bytes(word.encode("utf-8")) == heap.encode_bytes(word.encode("utf-8")), f"merge engines differ on {word!r}"
+    print(f"loop and heap merge engines match on {len(words)} words")
\ No newline at end of file
@@ -0,0 +1,243 @@
+"""
+A compact binary format for BPE tokenizers that can be memory-mapped, for fast startup.
+
+`vocab.json` has to be parsed and turned into several dicts (vocab, inverse vocab, merge ranks) in every process
+that uses the tokenizer. The compiled file instead stores flat arrays that are read straight from an mmap, so
+loading is ~free and all workers on a machine share the same pages. Lookup structures are built lazily.
+
+Layout (native byte order, all arrays 4-byte aligned):
+    header          MAGIC, then (version, byte order marker, n_tokens, id_limit, n_merges, blob_size) as uint32
+    offsets         uint32[n_tokens + 1]  start of each token in `blob`, tokens sorted by their utf-8 bytes
+    sorted_ids      uint32[n_tokens]      id of each token, in sorted order
+    id_to_sorted    uint32[id_limit]      position of each id in sorted order (MISSING for unused ids)
+    merge_left      uint32[n_merges]      left token id of each merge, in rank order
+    merge_right     uint32[n_merges]      right token id of each merge
+    merge_result    uint32[n_merges]      id of the merged token (MISSING if it's not in the vocab)
+    blob            utf-8 bytes of all tokens, sorted
+Usage:
+    python compiled_tokenizer.py compile vocab.json vocab.bin
+    python compiled_tokenizer.py benchmark vocab.json vocab.bin
+"""
+import argparse
+import json
+import mmap
+import struct
+import subprocess
+import sys
+from array import array
+from collections.abc import MutableMapping
+from typing import Dict, Iterator, List, Tuple
+
+MAGIC = b"BPETOK\x00\x01"
+VERSION = 1
+BYTE_ORDER_MARK = 0x01020304
+HEADER = struct.Struct("=8s6I")
+MISSING = 0xFFFFFFFF
+
+
+def is_compiled_tokenizer(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def compile_tokenizer(vocab_file: str, output_file: str):
+    """
+    Compiles a `vocab.json` (HF's BPE model format: "vocab" and "merges") into the binary format.
+    """
+    with open(vocab_file, "r") as f:
+        vocab_data = json.load(f)
+    token_to_id = vocab_data["vocab"]
+    tokens = sorted(token_to_id, key=lambda token: token.encode("utf-8"))
+    id_limit = max(token_to_id.values()) + 1 if tokens else 0
+
+    blob = bytearray()
+    offsets = array("I", [0])
+    for token in tokens:
+        blob += token.encode("utf-8")
+        offsets.append(len(blob))
+    sorted_ids = array("I", [token_to_id[token] for token in tokens])
+    id_to_sorted = array("I", [MISSING]) * id_limit
+    for position, token in enumerate(tokens):
+        id_to_sorted[token_to_id[token]] = position
+
+    merge_left, merge_right, merge_result = array("I"), array("I"), array("I")
+    for merge in vocab_data["merges"]:
+        first, second = merge.split()
+        if first not in token_to_id or second not in token_to_id:
+            raise ValueError(f"Merge {merge} uses a token that is not in the vocab")
+        merge_left.append(token_to_id[first])
+        merge_right.append(token_to_id[second])
+        merge_result.append(token_to_id.get(first + second, MISSING))
+
+    with open(output_file, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, BYTE_ORDER_MARK, len(tokens), id_limit, len(merge_left), len(blob)))
+        for section in (offsets, sorted_ids, id_to_sorted, merge_left, merge_right, merge_result):
+            f.write(section.tobytes())
+        f.write(bytes(blob))
+
+
+class CompiledTokenizer:
+    """
+    Read-only view of a compiled tokenizer file. Arrays are memoryviews into the mmap, nothing is copied.
+    """
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, byte_order, self.n_tokens, self.id_limit, self.n_merges, blob_size = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a compiled tokenizer (version {VERSION})")
+        if byte_order != BYTE_ORDER_MARK:
+            raise ValueError(f"{path} was compiled on a machine with a different byte order")
+        view = memoryview(self.mmap)
+        position = HEADER.size
+        sections = []
+        for length in (self.n_tokens + 1, self.n_tokens, self.id_limit, self.n_merges, self.n_merges, self.n_merges):
+            sections.append(view[position:position + 4 * length].cast("I"))
+            position += 4 * length
+        self.offsets, self.sorted_ids, self.id_to_sorted, self.merge_left, self.merge_right, self.merge_result = sections
+        self.blob = view[position:position + blob_size]
+
+    def token_at(self, position: int) -> str:
+        return str(self.blob[self.offsets[position]:self.offsets[position + 1]], "utf-8")
+
+    def token_id(self, token: str) -> int:
+        """
+        Binary search for a token. Returns -1 if it's not in the vocab.
+        """
+        key = token.encode("utf-8")
+        low, high = 0, self.n_tokens
+        while low < high:
+            mid = (low + high) // 2
+            if bytes(self.blob[self.offsets[mid]:self.offsets[mid + 1]]) < key:
+                low = mid + 1
+            else:
+                high = mid
+        if low < self.n_tokens and bytes(self.blob[self.offsets[low]:self.offsets[low + 1]]) == key:
+            return self.sorted_ids[low]
+        return -1
+
+    def token(self, index: int) -> str:
+        """
+        Returns the token with id `index`, or None.
+        """
+        if 0 <= index < self.id_limit and self.id_to_sorted[index] != MISSING:
+            return self.token_at(self.id_to_sorted[index])
+        return None
+
+    # builders for the structures `BPE` needs. `BPE` only calls these the first time an attribute is used.
+    def build_merge_table(self) -> Dict[Tuple[int, int], Tuple[int, int]]:
+        merge_table = {}
+        for rank, (left, right, result) in enumerate(zip(self.merge_left, self.merge_right, self.merge_result)):
+            if result != MISSING:
+                merge_table[(left, right)] = (rank, result)
+        return merge_table
+
+    def build_bpe_ranks(self) -> Dict[Tuple[str, str], int]:
+        return {(self.token(left), self.token(right)): rank for rank, (left, right) in enumerate(zip(self.merge_left, self.merge_right))}
+
+    def build_merges(self) -> List[str]:
+        return [f"{self.token(left)} {self.token(right)}" for left, right in zip(self.merge_left, self.merge_right)]
+
+
+class MappedVocab(MutableMapping):
+    """
+    token -> id mapping backed by a compiled tokenizer. New tokens (`add_token`) go in a small dict on top.
+    """
+    def __init__(self, compiled: CompiledTokenizer):
+        self.compiled = compiled
+        self.added = {}
+
+    def __getitem__(self, token: str) -> int:
+        if token in self.added:
+            return self.added[token]
+        index = self.compiled.token_id(token)
+        if index < 0:
+            raise KeyError(token)
+        return index
+
+    def __setitem__(self, token: str, index: int):
+        self.added[token] = index
+
+    def __delitem__(self, token: str):
+        del self.added[token]
+
+    def __iter__(self) -> Iterator[str]:
+        for position in range(self.compiled.n_tokens):
+            yield self.compiled.token_at(position)
+        yield from self.added
+
+    def __len__(self) -> int:
+        return self.compiled.n_tokens + len(self.added)
+
+
+class MappedIdToToken(MutableMapping):
+    """
+    id -> token mapping backed by a compiled tokenizer, with a small dict on top for added tokens.
+    """
+    def __init__(self, compiled: CompiledTokenizer):
+        self.compiled = compiled
+        self.added = {}
+
+    def __getitem__(self, index: int) -> str:
+        if index in self.added:
+            return self.added[index]
+        token = self.compiled.token(index)
+        if token is None:
+            raise KeyError(index)
+        return token
+
+    def __setitem__(self, index: int, token: str):
+        self.added[index] = token
+
+    def __delitem__(self, index: int):
+        del self.added[index]
+
+    def __iter__(self) -> Iterator[int]:
+        for position in range(self.compiled.n_tokens):
+            yield self.compiled.sorted_ids[position]
+        yield from self.added
+
+    def __len__(self) -> int:
+        return self.compiled.n_tokens + len(self.added)
+
+
+# Startup benchmark: every measurement runs in a fresh interpreter, like a new worker would
+STARTUP_SCRIPT = """
+import resource, time
+start = time.perf_counter()
+from minimal_hf_tok import MySlowTokenizer
+imported = time.perf_counter()
+tokenizer = MySlowTokenizer({path!r})
+tokenizer.encode("Startup benchmark: the quick brown fox jumps over the lazy dog.")
+ready = time.perf_counter()
+print(imported - start, ready - imported, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+def benchmark_startup(paths: List[str], repeats: int = 5):
+    print(f"{'file':>16} {'load+encode (ms)':>18} {'max RSS (MB)':>14}")
+    for path in paths:
+        load_times, rss = [], []
+        for _ in range(repeats):
+            output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT.format(path=path)], capture_output=True, text=True, check=True)
+            _, load_time, max_rss = output.stdout.split()
+            load_times.append(float(load_time) * 1000)
+            rss.append(int(max_rss) / 1024) # ru_maxrss is in KB on Linux
+        print(f"{path:>16} {min(load_times):18.1f} {min(rss):14.1f}")
+
+
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers(dest="command", required=True)
+compile_parser = subparsers.add_parser("compile", help="Compile a vocab.json into the binary format")
+compile_parser.add_argument("vocab_file", type=str)
+compile_parser.add_argument("output_file", type=str)
+benchmark_parser = subparsers.add_parser("benchmark", help="Compare startup time and RSS of tokenizer files")
+benchmark_parser.add_argument("files", type=str, nargs="+")
+benchmark_parser.add_argument("--repeats", type=int, default=5)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.command == "compile":
+        compile_tokenizer(args.vocab_file, args.output_file)
+        print(f"Compiled {args.vocab_file} to {args.output_file}")
+    else:
+        benchmark_startup(args.files, args.repeats)
@@ -1,55 +1,396 @@
-from transformers.tokenization_utils import Trie
-from transformers import AutoTokenizer
 import json
-from typing import Dict, Tuple, Union, List, Any
+from typing import Dict, Tuple, Union, List, Any, Iterable, Iterator
 import regex as re # regex is cooler than re
+import io
+import os
+import codecs
+import time
+import contextlib
+import copy
+import threading
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
 from bpe import BPE
+from aho_corasick import AhoCorasickSplitter
+from profiling import EncodeProfiler
+from pre_tokenization import GPT2_PATTERN, iter_pre_tokenize
 
 
 EOS_TOKEN = "<|endoftext|>"
-class MyTrie(Trie):
+BATCH_BACKENDS = ("serial", "thread", "process")
+WHITESPACE = re.compile(r"\s") # same definition of whitespace as the pre-tokenization regex
+class MyTrie:
     """
-    HF's Trie implementation for added tokens. Shown here with minor changes for clarity.
+    HF's Trie implementation for added tokens. Shown here with minor changes for clarity, and copied so that importing
+    this module doesn't need `transformers`. Splits `text` in one pass, matching the longest added token first.
     """
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        # self.data = {} - our trie graph, stored as a dict of dicts
-        # self._tokens = set() - set of tokens in the trie
+    def __init__(self):
+        self.data = {} # our trie graph, stored as a dict of dicts. The key "" marks the end of a token
+        self._tokens = set() # set of tokens in the trie
 
     def add(self, word: str):
         """
-        Adds a word to the trie
+        Adds a word to the trie. Adding an empty or existing word does nothing
         """
-        return super().add(word)
-    
-    def split(self, word: str):
+        if not word:
+            return
+        self._tokens.add(word)
+        ref = self.data
+        for char in word:
+            ref = ref.setdefault(char, {})
+        ref[""] = 1
+
+    def split(self, text: str) -> List[str]:
         """
-        Splits a word into chunks based on the trie
+        Splits text into chunks based on the trie: "[CLS] This is a extra_id_100" -> ["[CLS]", " This is a ", "extra_id_100"]
         """
-        return super().split(word)
-    
+        # offsets count positions between characters: 0 is left of text[0]. `states` maps the start of every
+        # partial match to its position in the trie, since several matches can be live at once: with "blowing" and
+        # "lower" in the trie, "blower" has to become ["b", "lower"]
+        states = OrderedDict()
+        offsets = [0] # where to cut. len(text) is added at the end
+        skip = 0 # after a match, the lookahead may have consumed text past `current`
+        for current, current_char in enumerate(text):
+            if skip and current < skip:
+                # prevents the lookahead from matching twice, like extra_id_100 and id_100
+                continue
+            to_remove = set() # partial matches that stop matching at this character
+            reset = False # set on the first full match: the algorithm is greedy
+            for start, trie_pointer in states.items():
+                if "" in trie_pointer:
+                    # a full match. Look ahead for the longest match, also among partial matches that started earlier:
+                    # extra_id_1 vs extra_id_100, or "[CLS]" when "L" is an added token too
+                    for lookstart, looktrie_pointer in states.items():
+                        if lookstart > start:
+                            break # later partial matches don't matter
+                        elif lookstart < start:
+                            # pointers of earlier matches were already moved past `current`
+                            lookahead_index = current + 1
+                            end = current + 1
+                        else:
+                            lookahead_index = current
+                            end = current
+                        next_char = text[lookahead_index] if lookahead_index < len(text) else None
+                        if "" in looktrie_pointer:
+                            start = lookstart
+                            end = lookahead_index
+                            skip = lookahead_index
+                        while next_char in looktrie_pointer:
+                            looktrie_pointer = looktrie_pointer[next_char]
+                            lookahead_index += 1
+                            if "" in looktrie_pointer:
+                                start = lookstart
+                                end = lookahead_index
+                                skip = lookahead_index
+                            if lookahead_index == len(text):
+                                break
+                            next_char = text[lookahead_index]
+                    offsets.append(start)
+                    offsets.append(end)
+                    reset = True
+                    break
+                elif current_char in trie_pointer:
+                    # the partial match gets longer by one character
+                    states[start] = trie_pointer[current_char]
+                else:
+                    # can't delete while iterating over `states`
+                    to_remove.add(start)
+            if reset:
+                states = {}
+            else:
+                for start in to_remove:
+                    del states[start]
+            # start tracking a new partial match if an added token starts with this character
+            if current >= skip and current_char in self.data:
+                states[current] = self.data[current_char]
+        # a match can end with the text. The longest one has the lowest start, so it comes first
+        for start, trie_pointer in states.items():
+            if "" in trie_pointer:
+                offsets.append(start)
+                offsets.append(len(text))
+                break
+        return self.cut_text(text, offsets)
+
+    def cut_text(self, text: str, offsets: List[int]) -> List[str]:
+        offsets.append(len(text))
+        tokens = []
+        start = 0
+        for end in offsets:
+            # skips zero-width cuts (a match at index 0, two consecutive matches) and, like HF, out-of-order offsets
+            if start >= end:
+                continue
+            tokens.append(text[start:end])
+            start = end
+        return tokens
+
     def __repr__(self) -> str:
         # format data dict into a json
         return json.dumps(self.data, indent=4)
 
 
+# Implementations for splitting on added tokens. `MyTrie` is HF's, `AhoCorasickSplitter` scales to many added tokens
+SPLITTERS = {"trie": MyTrie, "aho_corasick": AhoCorasickSplitter}
+
+
+class LRUCache:
+    """
+    A bounded least-recently-used cache for BPE results. Keys are utf-8 encoded words (b" the"), values are tuples of token ids.
+    Natural text is Zipfian, so a small cache catches most words. Counters are kept to help size the cache.
+    Not thread-safe (`move_to_end`/`popitem` race and counter updates get lost), so the "thread" batch backend gives
+    each thread its own cache, see `MySlowTokenizer._thread_tokenizer`. A lock made `encode` ~45% slower on cached words.
+    The counters of worker caches are collected by `MySlowTokenizer.cache_stats`.
+    """
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize # 0 disables the cache
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: bytes):
+        value = self.data.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.data.move_to_end(key) # mark as most recently used
+        self.hits += 1
+        return value
+
+    def put(self, key: bytes, value: Tuple[int, ...]):
+        if self.maxsize <= 0:
+            return
+        self.data[key] = value
+        if len(self.data) > self.maxsize:
+            self.data.popitem(last=False) # evict the least recently used entry
+            self.evictions += 1
+
+    def clear(self):
+        self.data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "maxsize": self.maxsize,
+            "size": len(self.data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __repr__(self) -> str:
+        return f"LRUCache({', '.join(f'{k}={v}' for k, v in self.stats().items())})"
+
+
+class IncrementalDecoder:
+    """
+    Decodes token ids one at a time, ex: as a model generates them. A token can end in the middle of a multi-byte
+    character, so incomplete UTF-8 sequences are held back and only complete text is returned.
+    """
+    def __init__(self, tokenizer: "MySlowTokenizer", errors: str = "strict"):
+        self.tokenizer = tokenizer
+        self.errors = errors
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors)
+
+    def add(self, index: int) -> str:
+        """
+        Adds one token id and returns the newly completed text (possibly empty).
+        """
+        return self.decoder.decode(self.tokenizer.convert_id_to_bytes(index))
+
+    def add_many(self, ids: List[int]) -> str:
+        return self.decoder.decode(b"".join([self.tokenizer.convert_id_to_bytes(index) for index in ids]))
+
+    def flush(self) -> str:
+        """
+        Call at the end of the stream. Raises (or replaces, depending on `errors`) if a character is still incomplete.
+        """
+        text = self.decoder.decode(b"", final=True)
+        self.decoder.reset()
+        return text
+
+    def reset(self):
+        self.decoder.reset()
+
+
+class EditableEncoding:
+    """
+    The ids of a document that gets edited, ex: in an editor or a RAG index. Along with the text and its ids, it keeps
+    the start of every pre-tokenized word and added token ("pieces") and the index of its first id, so that an edit
+    only re-tokenizes the text around it:
+    - tokenization restarts at the last piece boundary before the edit that is a safe cut (the same rule as
+      `encode_stream`): at least one character and the longest added token before the edit, not in a whitespace run
+    - it stops at the first boundary after the edit that was also a boundary before it. Everything after that point
+      is the same text split the same way, so the old ids are spliced back in
+    Boundaries are stored in blocks of `PIECES_PER_BLOCK` pieces, relative to the start of their block, so that an
+    edit only shifts block offsets instead of every boundary after it. Tokenizing costs ~the size of the edit plus a
+    few words on each side, the rest of an edit is copying `text` and `ids`.
+    `ids` is always `tokenizer.encode(text)`.
+    """
+    PIECES_PER_BLOCK = 1024
+
+    def __init__(self, tokenizer: "MySlowTokenizer", text: str = ""):
+        self.tokenizer = tokenizer
+        self._encode_all(text)
+
+    def _encode_all(self, text: str):
+        self.text = text
+        self.ids, starts, id_starts = self._encode_pieces(self.tokenizer._split_with_offsets(text), 0, 0)
+        # blocks of (start offsets, first id indices) relative to `_bases` and `_id_bases`
+        self._blocks, self._bases, self._id_bases = [], [], []
+        self._replace_blocks(0, 0, starts, id_starts)
+        self._num_added_tokens = len(self.tokenizer.added_tokens)
+
+    def _encode_pieces(self, pieces: List[Tuple[int, str, bool]], offset: int, id_offset: int) -> Tuple[List[int], List[int], List[int]]:
+        # ids, start offsets and first id index of every piece, shifted by `offset` and `id_offset`
+        tokenizer = self.tokenizer
+        ids, starts, id_starts = [], [], []
+        for start, piece, is_added_token in pieces:
+            starts.append(offset + start)
+            id_starts.append(id_offset + len(ids))
+            if is_added_token:
+                ids.append(tokenizer.convert_token_to_id(piece))
+            else:
+                ids.extend(tokenizer._encode_word(piece.encode("utf-8")))
+        return ids, starts, id_starts
+
+    def _replace_blocks(self, first: int, last: int, starts: List[int], id_starts: List[int]):
+        # replaces blocks first..last-1 with blocks holding the given absolute boundaries
+        blocks, bases, id_bases = [], [], []
+        for k in range(0, len(starts), self.PIECES_PER_BLOCK):
+            base, id_base = starts[k], id_starts[k]
+            blocks.append(([start - base for start in starts[k:k + self.PIECES_PER_BLOCK]], [start - id_base for start in id_starts[k:k + self.PIECES_PER_BLOCK]]))
+            bases.append(base)
+            id_bases.append(id_base)
+        self._blocks[first:last] = blocks
+        self._bases[first:last] = bases
+        self._id_bases[first:last] = id_bases
+
+    def _locate(self, position: int) -> Tuple[int, int]:
+        # (block, index in block) of the last piece starting at or before `position`. The text must not be empty
+        block = max(bisect_right(self._bases, position) - 1, 0)
+        return block, max(bisect_right(self._blocks[block][0], position - self._bases[block]) - 1, 0)
+
+    def _absolute(self, block: int, begin: int = 0, end: int = None) -> Tuple[List[int], List[int]]:
+        starts, id_starts = self._blocks[block]
+        base, id_base = self._bases[block], self._id_bases[block]
+        return [base + start for start in starts[begin:end]], [id_base + start for start in id_starts[begin:end]]
+
+    @property
+    def starts(self) -> List[int]:
+        """
+        Start offset of every piece, in characters. Same as the offsets of `tokenizer._split_with_offsets(text)`
+        """
+        return [start for block in range(len(self._blocks)) for start in self._absolute(block)[0]]
+
+    def edit(self, begin: int, end: int, replacement: str = "") -> Tuple[int, int]:
+        """
+        Replaces `text[begin:end]` with `replacement` and updates the ids. Returns the range of `ids` that was
+        re-tokenized: ids before it are unchanged, ids after it are the old ones.
+        """
+        if not 0 <= begin <= end <= len(self.text):
+            raise ValueError(f"Invalid edit range ({begin}, {end}) for a text of length {len(self.text)}")
+        tokenizer = self.tokenizer
+        old_text = self.text
+        text = old_text[:begin] + replacement + old_text[end:]
+        if len(tokenizer.added_tokens) != self._num_added_tokens or not old_text:
+            self._encode_all(text) # ids were computed with another vocabulary, or there is nothing to reuse
+            return 0, len(self.ids)
+        margin = max((len(token) for token in tokenizer.added_tokens_trie._tokens), default=0)
+        delta = len(replacement) - (end - begin)
+        edit_end = begin + len(replacement) # in the new text
+        # 1. the piece to restart from: its start is unchanged by the edit and nothing before it depends on the edit
+        block, index = self._locate(begin - max(margin, 1))
+        restart = self._bases[block] + self._blocks[block][0][index]
+        while restart > 0 and WHITESPACE.match(old_text, restart - 1) and WHITESPACE.match(old_text, restart):
+            block, index = (block, index - 1) if index > 0 else (block - 1, len(self._blocks[block - 1][0]) - 1)
+            restart = self._bases[block] + self._blocks[block][0][index]
+        id_restart = self._id_bases[block] + self._blocks[block][1][index]
+        # 2. split a window of the new text after the restart point, growing it until a boundary past the edit matches
+        # an old boundary. Only boundaries up to the window's last safe cut are final
+        slack = 64 + margin
+        while True:
+            stop = min(len(text), edit_end + slack)
+            window = text[restart:stop]
+            pieces = tokenizer._split_with_offsets(window)
+            last = len(pieces) if stop == len(text) else tokenizer._last_safe_cut(window, pieces, margin)
+            sync = None
+            for j in range(last + 1):
+                position = restart + (pieces[j][0] if j < len(pieces) else len(window))
+                if position < edit_end:
+                    continue
+                # the same position in the old text. The end of the text counts as a boundary
+                old_position = position - delta
+                if old_position == len(old_text):
+                    sync = (len(self._blocks) - 1, len(self._blocks[-1][0]))
+                else:
+                    sync = self._locate(old_position)
+                    if self._bases[sync[0]] + self._blocks[sync[0]][0][sync[1]] != old_position:
+                        sync = None
+                if sync is not None:
+                    break
+            if sync is not None:
+                break
+            slack *= 2
+        # 3. splice: pieces[:j] replace the old pieces from the restart point to the sync point
+        new_ids, new_starts, new_id_starts = self._encode_pieces(pieces[:j], restart, id_restart)
+        sync_block, sync_index = sync
+        if sync_index < len(self._blocks[sync_block][0]):
+            id_sync = self._id_bases[sync_block] + self._blocks[sync_block][1][sync_index]
+        else:
+            id_sync = len(self.ids)
+        id_delta = len(new_ids) - (id_sync - id_restart)
+        self.ids[id_restart:id_sync] = new_ids
+        head_starts, head_id_starts = self._absolute(block, 0, index)
+        tail_starts, tail_id_starts = self._absolute(sync_block, sync_index)
+        self._replace_blocks(block, sync_block + 1, head_starts + new_starts + [start + delta for start in tail_starts],
+                             head_id_starts + new_id_starts + [start + id_delta for start in tail_id_starts])
+        # blocks after the edit move as a whole
+        first_moved = block + (len(head_starts) + len(new_starts) + len(tail_starts) + self.PIECES_PER_BLOCK - 1) // self.PIECES_PER_BLOCK
+        if delta or id_delta:
+            for moved in range(first_moved, len(self._blocks)):
+                self._bases[moved] += delta
+                self._id_bases[moved] += id_delta
+        self.text = text
+        return id_restart, id_restart + len(new_ids)
+
+
 class MySlowTokenizer:
     """
     A minimal implementation of HF's slow tokenizer, based on GPT2's tokenizer
     References:
     https://github.com/huggingface/transformers/blob/8aca43bdb3cb9a5020f6d57589d85679dc873b1c/src/transformers/models/gpt2/tokenization_gpt2.py
     """
-    def __init__(self, init_vocab_file: str = None):
-        self.added_tokens_trie = MyTrie() # trie for added tokens only
-        self.bpe = BPE(init_vocab_file)
+    def __init__(self, init_vocab_file: str = None, merge_engine: str = "loop", cache_size: int = 2**15, splitter: str = "aho_corasick"):
+        if splitter not in SPLITTERS:
+            raise ValueError(f"splitter should be one of {list(SPLITTERS)}, got {splitter}")
+        self.init_vocab_file = init_vocab_file # kept around so that pool workers can load the same vocab
+        self.splitter = splitter
+        self.added_tokens = [] # tokens added with `add_tokens`, in order
+        self.added_tokens_trie = SPLITTERS[splitter]() # splits text on added tokens only. Named after HF's trie
+        self.bpe = BPE(init_vocab_file, merge_engine=merge_engine)
+        self.cache = LRUCache(cache_size) # utf-8 encoded word -> token ids. Set cache_size=0 to disable
         self.vocab = self.bpe.token_to_id # nice to have vocab accessible here
+        # typecode of the id buffers of ragged batches and shards: uint16 if the vocab fits, else uint32. Chosen once,
+        # so that buffers from different batches (or from before `add_tokens`) always have the same dtype
+        self.id_typecode = "H" if len(self.vocab) <= 2**16 else "I"
         self.byte_encoder = self.bpe.byte_encoder
-        self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
+        self.byte_decoder = self.bpe.byte_decoder
         self.unk_token = EOS_TOKEN
 
         # Regex for pre-tokenization - breaking up a piece of text into words by splitting at whitespaces, contractions, etc. Borrowed from GPT-2
-        self.pattern_for_splitting = re.compile(r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+""")
+        self.pattern_for_splitting = re.compile(GPT2_PATTERN)
         self._load_added_tokens()
+        self._pool = None # worker pool for batch encoding, started on first use
+        self._pool_config = None
+        self._thread_local = None # per-thread tokenizers of the "thread" backend, see `_thread_tokenizer`
+        self._worker_cache_counts = {"hits": 0, "misses": 0, "evictions": 0} # see `cache_stats`
+        self._id_to_bytes = None # see `id_to_bytes`
+        self.profiler = None # set by `profile`
     
     def _load_added_tokens(self):
         # loads added tokens from json and adds them to the trie
@@ -57,48 +398,375 @@ class MySlowTokenizer:
         self.added_tokens_trie.add(EOS_TOKEN)
     
     def __call__(self, *args: Any, **kwargs: Any) -> Any:
-        self.encode(*args, **kwargs)
+        return self.encode(*args, **kwargs)
     
     def encode(self, text: str, **kwargs: Any) -> Any:
+        if self.profiler is not None:
+            return self._encode_profiled(text, **kwargs)
         text, kwargs = self.prepare_for_tokenization(text, **kwargs)
+        return self._encode_into(text, [])
 
+    def _encode_into(self, text: str, input_ids: List[int]) -> List[int]:
+        """
+        Appends the ids of `text` to `input_ids` and returns it. Lets `encode_batch_ragged` reuse a single list.
+        """
         # 1. Split text into chunks at the boundaries of added_tokens. Can be thought of as a pre-tokenization step.
         # "This isn't<|endoftext|> what you think" -> ["This isn't", "<|endoftext|>", " what you think"] 
         chunks = self.added_tokens_trie.split(text)
-        bpe_tokens = []
         for chunk in chunks:
             if chunk in self.added_tokens_trie._tokens:
-                # if chunk is an added token, directly add it to bpe_tokens
-                bpe_tokens.append(chunk)
+                # if chunk is an added token, directly add its id
+                input_ids.append(self.convert_token_to_id(chunk))
             else:
-                # 2. Tokenize each chunk
-                tokens = self._tokenize(chunk)
-                bpe_tokens.extend(tokens)
-        # 3. Convert tokens to ids
-        bpe_tokens = [self.convert_token_to_id(token) for token in bpe_tokens]
-        return bpe_tokens
-
-    def decode(self, ids: List[int], **kwargs: Any) -> str:
-        # 1. Convert ids to tokens
-        tokens = [self.convert_id_to_token(id_) for id_ in ids] 
-        text = "".join(tokens) # join tokens
-        # replace unicode symbols with normal characters
-        text = bytearray([self.byte_decoder[c] for c in text]).decode("utf-8")
-        return text
+                # 2. Tokenize each chunk and 3. convert tokens to ids. Done word by word so that results can be cached
+                for word in self.iter_pre_tokenize(chunk):
+                    input_ids.extend(self._encode_word(word.encode("utf-8")))
+        return input_ids
+
+    @contextlib.contextmanager
+    def profile(self, top_n: int = 10):
+        """
+        Profiles `encode` within a block, ex:
+        with tokenizer.profile() as profiler:
+            tokenizer.encode(text)
+        print(profiler.to_dict()) # or profiler.to_prometheus()
+        When not profiling, the only cost is one attribute check per `encode` call. Batch calls are profiled too: each
+        pool worker profiles its chunks, and the profiles are added to this one as the chunks come back (the time of
+        every stage is then summed over workers).
+        """
+        previous = self.profiler
+        self.profiler = EncodeProfiler(top_n)
+        try:
+            yield self.profiler
+        finally:
+            self.profiler = previous
+
+    def _encode_profiled(self, text: str, **kwargs: Any) -> List[int]:
+        """
+        Same as `encode`, with each stage timed.
+        """
+        profiler = self.profiler
+        clock = time.perf_counter
+        text, kwargs = self.prepare_for_tokenization(text, **kwargs)
+        start = clock()
+        chunks = self.added_tokens_trie.split(text)
+        profiler.record("split", clock() - start, len(text.encode("utf-8")), len(chunks))
+        input_ids = []
+        for chunk in chunks:
+            if chunk in self.added_tokens_trie._tokens:
+                start = clock()
+                input_ids.append(self.convert_token_to_id(chunk))
+                profiler.record("added_tokens", clock() - start, len(chunk.encode("utf-8")), 1)
+                continue
+            start = clock()
+            words = self.pre_tokenize(chunk)
+            profiler.record("pre_tokenize", clock() - start, len(chunk.encode("utf-8")), len(words))
+            for word in words:
+                start = clock()
+                word = word.encode("utf-8")
+                profiler.record("byte_encode", clock() - start, len(word), 1)
+                start = clock()
+                ids = self.cache.get(word)
+                profiler.record("cache", clock() - start, len(word), 0 if ids is None else len(ids))
+                if ids is None:
+                    start = clock()
+                    ids = tuple(self.bpe.encode_bytes(word))
+                    elapsed = clock() - start
+                    profiler.record("bpe", elapsed, len(word), len(ids))
+                    profiler.record_word(word, elapsed)
+                    self.cache.put(word, ids)
+                input_ids.extend(ids)
+        return input_ids
+
+    def decode(self, ids: Union[List[int], "np.ndarray"], errors: str = "strict", **kwargs: Any) -> str:
+        # HF does this in three steps: 1. convert ids to tokens, 2. join the tokens and 3. replace unicode symbols
+        # with normal characters. With a precomputed id -> bytes table, all three are one join.
+        if hasattr(ids, "tolist"):
+            ids = ids.tolist() # NumPy arrays, which can't be tested with `if ids`. Python ints also index faster
+        table = self.id_to_bytes
+        if ids and min(ids) >= 0:
+            try:
+                return b"".join([table[id_] for id_ in ids]).decode("utf-8", errors)
+            except (IndexError, TypeError):
+                pass # some ids aren't in the vocab
+        return b"".join([self.convert_id_to_bytes(id_) for id_ in ids]).decode("utf-8", errors)
+
+    @property
+    def id_to_bytes(self) -> List[bytes]:
+        """
+        Table from token id to the bytes of the token, built on first use. Unused ids are None.
+        """
+        if self._id_to_bytes is None:
+            table = [None] * (max(self.bpe.id_to_token, default=-1) + 1)
+            for id_, token in self.bpe.id_to_token.items():
+                table[id_] = self._token_to_bytes(token)
+            self._id_to_bytes = table
+        return self._id_to_bytes
+
+    def _token_to_bytes(self, token: str) -> bytes:
+        if all(char in self.byte_decoder for char in token):
+            return bytes([self.byte_decoder[char] for char in token])
+        return token.encode("utf-8") # added tokens can have characters outside of the byte-level alphabet
+
+    def convert_id_to_bytes(self, index: int) -> bytes:
+        """
+        Converts an id to the bytes of its token. Returns the bytes of the unk token if id is not in vocab.
+        """
+        table = self.id_to_bytes
+        if 0 <= index < len(table) and table[index] is not None:
+            return table[index]
+        return self._token_to_bytes(self.unk_token)
+
+    def incremental_decoder(self, errors: str = "strict") -> "IncrementalDecoder":
+        """
+        Returns a decoder that takes token ids one at a time, for streaming generated text.
+        """
+        return IncrementalDecoder(self, errors=errors)
+
+    def editable_encoding(self, text: str = "") -> "EditableEncoding":
+        """
+        Returns the encoding of `text` as an `EditableEncoding`: `encoding.edit(begin, end, replacement)` updates the
+        ids by re-tokenizing only around the edit. `encoding.ids` is always `encode(encoding.text)`.
+        """
+        return EditableEncoding(self, text)
     
+    def encode_batch(self, texts: List[str], backend: str = "serial", num_workers: int = None, chunk_size: int = None) -> List[List[int]]:
+        """
+        Encodes a list of texts. Results are in the same order as the inputs.
+
+        backend: "serial" encodes in this process, "thread" uses a thread pool (limited by the GIL, but useful if
+            texts come from I/O) and "process" uses a process pool. Pools are started once and reused across calls.
+            Each process worker loads the vocab a single time when it starts.
+        chunk_size: number of texts sent to a worker at once, to amortize IPC. Defaults to splitting the batch into
+            4 chunks per worker.
+        """
+        return self._map_batch(_encode_chunk, texts, backend, num_workers, chunk_size)
+
+    def encode_batch_ragged(self, texts: List[str], backend: str = "serial", num_workers: int = None, chunk_size: int = None) -> "RaggedIds":
+        """
+        Encodes a list of texts into a `RaggedIds`: one flat uint16/uint32 NumPy array of ids plus offsets, instead
+        of a list of lists. Ids are copied into a growable buffer as each text is encoded, so no list is kept per document.
+        Use `.pack(block_size, eos_id)` or `.pad(pad_id)` on the result to get fixed-size arrays. Same backends as `encode_batch`.
+        """
+        from ragged import RaggedIds # numpy is only needed here
+        parts = self._map_batch(_encode_ragged_chunk, texts, backend, num_workers, chunk_size)
+        if len(parts) == 1:
+            ids, lengths = parts[0]
+        else:
+            ids, lengths = array(self.id_typecode), array("q")
+            for part_ids, part_lengths in parts:
+                ids.extend(part_ids)
+                lengths.extend(part_lengths)
+        return RaggedIds.from_buffers(ids, lengths)
+
+    def decode_batch(self, batch_ids: List[List[int]], backend: str = "serial", num_workers: int = None, chunk_size: int = None) -> List[str]:
+        """
+        Decodes a list of token id lists. Same backends as `encode_batch`.
+        """
+        return self._map_batch(_decode_chunk, batch_ids, backend, num_workers, chunk_size)
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Number of tokens in `encode(text)`, without building the list of ids. Uses the word cache if enabled.
+        """
+        num_tokens = 0
+        for chunk in self.added_tokens_trie.split(text):
+            if chunk in self.added_tokens_trie._tokens:
+                num_tokens += 1
+            else:
+                for word in self.iter_pre_tokenize(chunk):
+                    num_tokens += len(self._encode_word(word.encode("utf-8")))
+        return num_tokens
+
+    def count_tokens_batch(self, texts: List[str], backend: str = "serial", num_workers: int = None, chunk_size: int = None) -> List[int]:
+        """
+        Number of tokens for each text. Same backends as `encode_batch`.
+        """
+        return self._map_batch(_count_chunk, texts, backend, num_workers, chunk_size)
+
+    def _map_batch(self, fn, inputs: list, backend: str, num_workers: int, chunk_size: int) -> list:
+        if backend not in BATCH_BACKENDS:
+            raise ValueError(f"backend should be one of {BATCH_BACKENDS}, got {backend}")
+        if backend == "serial" or not inputs:
+            return fn(inputs, self)
+        num_workers = num_workers or os.cpu_count()
+        if chunk_size is None:
+            chunk_size = max(1, -(-len(inputs) // (4 * num_workers)))
+        chunks = [inputs[i:i + chunk_size] for i in range(0, len(inputs), chunk_size)]
+        pool = self._get_pool(backend, num_workers)
+        top_n = None if self.profiler is None else self.profiler.top_n
+        if backend == "thread":
+            results = pool.map(lambda chunk: _run_chunk(fn, chunk, top_n, self._thread_tokenizer()), chunks)
+        else:
+            results = pool.map(_run_chunk, [fn] * len(chunks), chunks, [top_n] * len(chunks)) # workers use their own tokenizer, see `_init_worker`
+        outputs = []
+        # workers have their own cache and profiler: their counters are added up here, in the calling thread
+        for chunk_outputs, cache_counts, profiler in results:
+            outputs.extend(chunk_outputs)
+            for name, count in zip(("hits", "misses", "evictions"), cache_counts):
+                self._worker_cache_counts[name] += count
+            if profiler is not None and self.profiler is not None:
+                self.profiler.merge(profiler)
+        return outputs
+
+    def cache_stats(self) -> Dict[str, Any]:
+        """
+        Word cache counters. "serial" is `self.cache`, used by `encode` and the "serial" backend. Pool workers have
+        their own caches: "workers" adds up their hits, misses and evictions over all batch calls.
+        """
+        workers = dict(self._worker_cache_counts)
+        lookups = workers["hits"] + workers["misses"]
+        workers["hit_rate"] = workers["hits"] / lookups if lookups else 0.0
+        return {"serial": self.cache.stats(), "workers": workers}
+
+    def _get_pool(self, backend: str, num_workers: int):
+        # (re)start the pool if the config changed. Process workers need a restart if tokens were added
+        config = (backend, num_workers, len(self.added_tokens))
+        if self._pool is not None and self._pool_config == config:
+            return self._pool
+        self.close()
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor # imported on first use, it slows down imports
+        if backend == "thread":
+            self._pool = ThreadPoolExecutor(max_workers=num_workers)
+            self._thread_local = threading.local()
+        else:
+            if self.init_vocab_file is None:
+                raise ValueError("The process backend needs a tokenizer loaded from a vocab file")
+            initargs = (self.init_vocab_file, self.bpe.merge_engine, self.cache.maxsize, self.splitter, list(self.added_tokens))
+            self._pool = ProcessPoolExecutor(max_workers=num_workers, initializer=_init_worker, initargs=initargs)
+        self._pool_config = config
+        return self._pool
+
+    def close(self):
+        """
+        Shuts down the worker pool used by `encode_batch`/`decode_batch`, if any.
+        """
+        if self._pool is not None:
+            self._pool.shutdown()
+        self._pool = None
+        self._pool_config = None
+        self._thread_local = None
+
+    def _thread_tokenizer(self) -> "MySlowTokenizer":
+        # The tokenizer used by the current thread of the "thread" pool: a shallow copy with its own word cache, like
+        # process workers have their own. Copies are made once per thread, and dropped with the pool
+        tokenizer = getattr(self._thread_local, "tokenizer", None)
+        if tokenizer is None:
+            tokenizer = copy.copy(self)
+            tokenizer.cache = LRUCache(self.cache.maxsize)
+            tokenizer.profiler = None # set for each chunk by `_run_chunk`
+            tokenizer._pool = None
+            self._thread_local.tokenizer = tokenizer
+        return tokenizer
+
     def _tokenize(self, text: str) -> List[str]:
         all_tokens = []
         # Pre-tokenization: split text into words based on regex. "This isn't" -> ["This", " isn", "'t"]
         words = self.pre_tokenize(text)
         for word in words:
             # Unicode string encoding. " isn" -> bytes object -> "Ġisn"
-            word = "".join([self.byte_encoder[b] for b in word.encode("utf-8")]) 
+            word = word.encode("utf-8").decode("latin-1").translate(self.byte_encoder)
             tokens = self.bpe(word, dont_byte_encode=True).split(" ") # we already encoded the chunk to unicode strings
             all_tokens.extend(tokens)
         return all_tokens
 
+    def _encode_word(self, word: bytes) -> Tuple[int, ...]:
+        ids = self.cache.get(word)
+        if ids is None:
+            # BPE directly on token ids, no need to map bytes to unicode strings and back
+            ids = tuple(self.bpe.encode_bytes(word))
+            self.cache.put(word, ids)
+        return ids
+
+    def encode_stream(self, source: Union[io.IOBase, Iterable[Union[str, bytes]]], chunk_size: int = 2**16) -> Iterator[List[int]]:
+        """
+        Encodes a file (text or binary mode) or an iterable of str/bytes pieces, yielding blocks of token ids.
+        Concatenating the blocks gives the same ids as `encode` on the whole text, but only about `chunk_size`
+        characters are kept in memory. (The exception is a single pre-tokenized word longer than that, which has
+        to be held in full)
+
+        The text read so far is only cut at a safe boundary: the start of a pre-tokenized word or added token, such
+        that nothing before it can change with more text. That means:
+        - the last word can still grow (" hel" -> " hello"), so it's held back
+        - whitespace runs are never cut, since how they are split depends on the character after the run
+        - an added token could start in the last `max added token length` characters, so no cut happens there
+        - bytes are decoded incrementally, so a multi-byte character split across reads is held back too
+        """
+        added_tokens = self.added_tokens_trie._tokens
+        margin = max((len(token) for token in added_tokens), default=0)
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        buffer = ""
+        min_length = chunk_size # wait for this much text before trying to cut, so that we don't re-split small buffers
+        for piece in _read_pieces(source, chunk_size):
+            if isinstance(piece, bytes):
+                piece = decoder.decode(piece)
+            buffer += piece
+            if len(buffer) < min_length:
+                continue
+            pieces = self._split_with_offsets(buffer)
+            last = self._last_safe_cut(buffer, pieces, margin)
+            if last > 0:
+                yield self._pieces_to_ids(pieces[:last])
+                buffer = buffer[pieces[last][0]:]
+                min_length = len(buffer) + chunk_size
+            else:
+                min_length = 2 * len(buffer) # one very long word, back off geometrically
+        buffer += decoder.decode(b"", final=True) # raises if the input ends with an incomplete character
+        if buffer:
+            yield self.encode(buffer)
+
+    def _last_safe_cut(self, text: str, pieces: List[Tuple[int, str, bool]], margin: int) -> int:
+        """
+        Index of the last piece of `text` (from `_split_with_offsets`) whose start is a safe cut: the pieces before it
+        stay the same whatever text is appended. 0 if there is none. `margin` is the length of the longest added token.
+        """
+        # find the last piece starting at or before the limit: the cut happens at its start
+        limit = len(text) - margin
+        last = 0
+        for k in range(1, len(pieces)):
+            start = pieces[k][0]
+            if start > limit:
+                break
+            # inside a whitespace run, the split depends on what follows the run ("  a" -> " ", " a"), so no cut there
+            if not (WHITESPACE.match(text, start - 1) and WHITESPACE.match(text, start)):
+                last = k
+        return last
+
+    def _split_with_offsets(self, text: str) -> List[Tuple[int, str, bool]]:
+        """
+        Splits text into added tokens and pre-tokenized words. Returns (start offset, piece, is added token) tuples
+        """
+        pieces = []
+        start = 0
+        for chunk in self.added_tokens_trie.split(text):
+            if chunk in self.added_tokens_trie._tokens:
+                pieces.append((start, chunk, True))
+            else:
+                for match in self.pattern_for_splitting.finditer(chunk):
+                    pieces.append((start + match.start(), match.group(), False))
+            start += len(chunk)
+        return pieces
+
+    def _pieces_to_ids(self, pieces: List[Tuple[int, str, bool]]) -> List[int]:
+        input_ids = []
+        for _, piece, is_added_token in pieces:
+            if is_added_token:
+                input_ids.append(self.convert_token_to_id(piece))
+            else:
+                input_ids.extend(self._encode_word(piece.encode("utf-8")))
+        return input_ids
+
     def pre_tokenize(self, text: str) -> List[str]:
-        return self.pattern_for_splitting.findall(text)
+        return list(self.iter_pre_tokenize(text))
+
+    def iter_pre_tokenize(self, text: str) -> Iterator[str]:
+        """
+        Yields the words of `pattern_for_splitting.findall(text)` lazily. GPT-2's pattern takes the fast path of
+        `pre_tokenization.iter_pre_tokenize` (ASCII-only regex for ASCII text), any other pattern is matched as is.
+        """
+        if self.pattern_for_splitting.pattern == GPT2_PATTERN:
+            return iter_pre_tokenize(text)
+        return (match.group() for match in self.pattern_for_splitting.finditer(text))
     
     def prepare_for_tokenization(self, text: str, **kwargs: Any) -> Tuple[str, Dict[str, Any]]:
         """
@@ -123,9 +791,15 @@ class MySlowTokenizer:
         if isinstance(new_tokens, str):
             new_tokens = [new_tokens]
         for token in new_tokens:
+            if self.id_typecode == "H" and len(self.vocab) >= 2**16 and token not in self.vocab:
+                raise ValueError(f"Can't add {token}: ids of this tokenizer are stored as uint16 (`id_typecode`), id {len(self.vocab)} doesn't fit")
             self.bpe.add_token(token) # add to vocab first
             self.added_tokens_trie.add(token)
+            self.added_tokens.append(token)
             print(f"Added {token} to the vocabulary.")
+        # cached ids and the decoding table were computed with the old vocabulary
+        self.cache.clear()
+        self._id_to_bytes = None
     
     def convert_token_to_id(self, token: str) -> int:
         """
@@ -151,9 +825,68 @@ class MySlowTokenizer:
     def nvocab(self) -> int:
         return len(self.vocab)
 
+def _read_pieces(source: Union[io.IOBase, Iterable[Union[str, bytes]]], chunk_size: int) -> Iterator[Union[str, bytes]]:
+    # file objects are read in fixed-size chunks, anything else is assumed to be an iterable of pieces
+    if hasattr(source, "read"):
+        while True:
+            piece = source.read(chunk_size)
+            if not piece:
+                return
+            yield piece
+    else:
+        yield from source
+
+# Batch helpers. These live at module level so that they can be sent to process pool workers
+_worker_tokenizer = None
+
+def _init_worker(vocab_file: str, merge_engine: str, cache_size: int, splitter: str, added_tokens: List[str]):
+    # runs once per worker process: load the vocab and replay added tokens (quietly)
+    global _worker_tokenizer
+    _worker_tokenizer = MySlowTokenizer(vocab_file, merge_engine=merge_engine, cache_size=cache_size, splitter=splitter)
+    with contextlib.redirect_stdout(io.StringIO()):
+        _worker_tokenizer.add_tokens(added_tokens)
+
+def _run_chunk(fn, inputs: list, profile_top_n: int = None, tokenizer: MySlowTokenizer = None) -> Tuple[list, Tuple[int, int, int], EncodeProfiler]:
+    # runs `fn` on a chunk in a pool worker. Returns its outputs with the hits, misses and evictions of the worker's
+    # cache during the chunk, and the worker's profile of the chunk if the caller is profiling (else None)
+    tokenizer = tokenizer or _worker_tokenizer
+    cache = tokenizer.cache
+    before = (cache.hits, cache.misses, cache.evictions)
+    tokenizer.profiler = None if profile_top_n is None else EncodeProfiler(profile_top_n)
+    try:
+        outputs = fn(inputs, tokenizer)
+    finally:
+        profiler, tokenizer.profiler = tokenizer.profiler, None
+    return outputs, (cache.hits - before[0], cache.misses - before[1], cache.evictions - before[2]), profiler
+
+def _encode_chunk(texts: List[str], tokenizer: MySlowTokenizer = None) -> List[List[int]]:
+    tokenizer = tokenizer or _worker_tokenizer
+    return [tokenizer.encode(text) for text in texts]
+
+def _encode_ragged_chunk(texts: List[str], tokenizer: MySlowTokenizer = None) -> List[Tuple[array, array]]:
+    # a single (ids, lengths) output per chunk, so that `_map_batch` keeps the chunks in order
+    tokenizer = tokenizer or _worker_tokenizer
+    ids, lengths = array(tokenizer.id_typecode), array("q")
+    scratch = [] # reused for every text: `array.fromlist` is much faster than extending an array with tuples
+    for text in texts:
+        scratch.clear()
+        tokenizer._encode_into(tokenizer.prepare_for_tokenization(text)[0], scratch)
+        ids.fromlist(scratch)
+        lengths.append(len(scratch))
+    return [(ids, lengths)]
+
+def _count_chunk(texts: List[str], tokenizer: MySlowTokenizer = None) -> List[int]:
+    tokenizer = tokenizer or _worker_tokenizer
+    return [tokenizer.count_tokens(text) for text in texts]
+
+def _decode_chunk(batch_ids: List[List[int]], tokenizer: MySlowTokenizer = None) -> List[str]:
+    tokenizer = tokenizer or _worker_tokenizer
+    return [tokenizer.decode(ids) for ids in batch_ids]
+
 if __name__ == "__main__":
     input_text = "This isn't<|myspecialtoken|> that   simple\n\t"
     new_token = "<|myspecialtoken|>"
+    from transformers import AutoTokenizer # only needed for the comparison
     my_tokenizer = MySlowTokenizer("vocab.json")
     gpt2_tokenizer = AutoTokenizer.from_pretrained("gpt2", use_fast=False)
     my_tokenizer.add_tokens(new_token)
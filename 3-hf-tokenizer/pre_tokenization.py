@@ -0,0 +1,176 @@
+"""
+Fast pre-tokenization with GPT-2's pattern. Same output as `pattern.findall(text)`, but:
+- long pure-ASCII stretches of text (containing an aligned block of `ASCII_BLOCK` ASCII characters) go through an ASCII-only version of the
+  pattern, compiled with the standard library's `re`. It spells out the character classes (no `\\p{L}` lookups) and
+  is ~2x faster than the `regex` module. Everything else (non-English text, with only short ASCII runs of spaces and
+  punctuation between words) is matched by the Unicode pattern in windows of at least `WINDOW` characters, so it
+  costs a few big `findall` calls, like the plain pattern.
+- words are yielded lazily, window by window, so a long document never becomes one big list of words.
+
+Text can only be cut where the pre-tokenization doesn't depend on what's on the other side: right before a
+whitespace character that follows a non-whitespace character. No pattern alternative matches across such a
+boundary ("a b" -> "a", " b"), and the pattern has no lookbehind, so both sides can be matched separately.
+
+Run `python pre_tokenization.py` for a differential test against `findall` on random Unicode text, and a benchmark.
+"""
+import argparse
+import random
+import re as stdlib_re
+import time
+from typing import Iterator
+import regex as re
+
+# Pre-tokenization pattern of GPT-2: contractions, letters, numbers, other symbols, whitespace
+GPT2_PATTERN = r"""'s|'t|'re|'ve|'m|'ll|'d| ?\p{L}+| ?\p{N}+| ?[^\s\p{L}\p{N}]+|\s+(?!\S)|\s+"""
+UNICODE_PATTERN = re.compile(GPT2_PATTERN)
+# The same pattern restricted to ASCII. Careful: for `regex`, \x1c-\x1f are not whitespace (unlike `str.isspace`)
+ASCII_WHITESPACE = r"\t\n\x0b\x0c\r "
+ASCII_PATTERN = stdlib_re.compile(
+    rf"""'s|'t|'re|'ve|'m|'ll|'d| ?[A-Za-z]+| ?[0-9]+| ?[^{ASCII_WHITESPACE}A-Za-z0-9]+|[{ASCII_WHITESPACE}]+(?![^{ASCII_WHITESPACE}])|[{ASCII_WHITESPACE}]+"""
+)
+ASCII_BLOCK = 128 # shorter ASCII runs aren't worth switching patterns
+ASCII_RUN = stdlib_re.compile(r"[\x00-\x7f]+")
+SAFE_CUT = re.compile(r"(?<=\S)\s")
+LAST_SAFE_CUT = re.compile(r"(?r)(?<=\S)\s") # searches backwards
+WINDOW = 2**14 # characters matched at once
+
+
+def _cut_before(text: str, low: int, index: int) -> int:
+    # last safe cut in [low, index], or `low`
+    match = LAST_SAFE_CUT.search(text, low, index + 1)
+    return match.start() if match else low
+
+
+def _cut_after(text: str, index: int, high: int) -> int:
+    # first safe cut in [index, high), or `high`
+    match = SAFE_CUT.search(text, index, high)
+    return match.start() if match else high
+
+
+def _next_ascii_block(text: str, position: int, block: int) -> int:
+    # start of the first aligned block of `block` ASCII characters at or after `position`, or -1. Any ASCII run of
+    # 2 * block characters contains one. Checking blocks with `str.isascii` is much cheaper than searching for long
+    # runs with a regex, which would try every position of non-English text
+    for start in range(-(-position // block) * block, len(text) - block + 1, block):
+        if text[start:start + block].isascii():
+            return start
+    return -1
+
+
+def iter_pre_tokenize(text: str, window: int = WINDOW, ascii_block: int = ASCII_BLOCK) -> Iterator[str]:
+    """
+    Yields the same words as `UNICODE_PATTERN.findall(text)`.
+    """
+    position, length = 0, len(text)
+    while position < length:
+        block_start = _next_ascii_block(text, position, ascii_block)
+        if block_start < 0:
+            ascii_start = ascii_end = length
+        else:
+            # the ASCII path gets the rest of the run between its first and last safe cuts
+            run_end = ASCII_RUN.match(text, block_start).end()
+            ascii_start = _cut_after(text, block_start, run_end)
+            ascii_end = _cut_before(text, ascii_start, run_end)
+            if ascii_end == ascii_start:
+                # no room for the ASCII path (ex: one very long word), the run goes to the Unicode path
+                ascii_start = ascii_end = _cut_after(text, run_end, length)
+        # matched `window` characters or so at a time, up to the next safe cut
+        for pattern, end in ((UNICODE_PATTERN, ascii_start), (ASCII_PATTERN, ascii_end)):
+            while position < end:
+                stop = _cut_after(text, min(position + window, end), end)
+                yield from pattern.findall(text, position, stop)
+                position = stop
+
+
+def random_text(rng: random.Random, length: int) -> str:
+    """
+    Random text that stresses the pattern: all kinds of whitespace, letters and numbers from several scripts,
+    combining marks, emoji, contractions, and long runs.
+    """
+    pieces = [
+        " ", "  ", "\t", "\n", "\r\n", "\x0b", "\x0c", "\x1c", "\x1f", "\x85", "\xa0", " ", "　",
+        "a", "Z", "word", " the", "'s", "'t", "'re", "'ve", "'m", "'ll", "'d", "'", "'S", "don't",
+        "0", "42", "٣", "²", "½", "Ⅻ", "é", "é", "ß", "Ω", "я", "中文", "日本", "한국", "ا", "ह", "ไทย",
+        "!", "?!", "...", "_", "-", "$", "€", "→", "🤗", "👍🏽", "​", "﻿", "\x00", "\x7f",
+    ]
+    chars = [rng.choice(pieces) for _ in range(length)]
+    if rng.random() < 0.3:
+        chars.append(rng.choice(pieces) * rng.randint(10, 200)) # long run
+    rng.shuffle(chars)
+    return "".join(chars)
+
+
+# Sentences for the benchmark corpora besides --file, shuffled and repeated with a fixed seed
+SENTENCES = {
+    "russian": [
+        "Утром город медленно просыпался, и на улицах появлялись первые прохожие.",
+        "Старый учитель говорил, что главное в науке — это терпение и любопытство.",
+        "В библиотеке было тихо, только иногда шелестели страницы толстых книг.",
+        "Мы долго спорили о том, какой путь короче, но в итоге заблудились оба раза.",
+        "Осенью листья в парке становятся золотыми, а воздух пахнет дождём и дымом.",
+        "Поезд опоздал на сорок минут, поэтому встреча началась без нас.",
+    ],
+    "accented latin": [
+        "Le café près de la gare sert un excellent crème brûlée, même le dimanche.",
+        "Über die Brücke in Zürich gehen täglich tausende Pendler zur Arbeit.",
+        "La señora Núñez compró piñas y jamón en el mercado de la esquina.",
+        "À l'été, nous étions à Besançon pour la fête de la musique.",
+        "Die Größe des Gebäudes überraschte selbst die erfahrenen Architekten.",
+        "São Paulo é a maior cidade do Brasil, com milhões de habitantes.",
+    ],
+}
+
+
+def make_corpus(sentences, num_sentences: int, seed: int) -> str:
+    rng = random.Random(seed)
+    return " ".join(rng.choice(sentences) + ("\n\n" if rng.random() < 0.2 else "") for _ in range(num_sentences))
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--num_texts", type=int, default=5000)
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--file", type=str, default="README.md", help="Text for the benchmark")
+parser.add_argument("--num_sentences", type=int, default=5000, help="Size of the non-English benchmark corpora")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    rng = random.Random(args.seed)
+    for i in range(args.num_texts):
+        text = random_text(rng, rng.randint(0, 200))
+        expected = UNICODE_PATTERN.findall(text)
+        # small windows and runs, so that switching between the paths and cutting windows is exercised too
+        for window, ascii_block in [(1, 1), (7, 3), (WINDOW, 8), (WINDOW, ASCII_BLOCK)]:
+            output = list(iter_pre_tokenize(text, window, ascii_block))
+            assert output == expected, f"pre-tokenization differs for {text!r} (window {window}, ascii_block {ascii_block}):\n{output}\n{expected}"
+    print(f"iter_pre_tokenize matches findall on {args.num_texts} random texts")
+
+    from bpe import bytes_to_unicode
+    byte_encoder = bytes_to_unicode()
+    with open(args.file, "r", encoding="utf-8") as f:
+        text = f.read()
+    words = UNICODE_PATTERN.findall(text)
+    # latin-1 maps each byte to the code point with the same value, so `byte_encoder` works as a `str.translate` table
+    for word in words:
+        assert word.encode("utf-8").decode("latin-1").translate(byte_encoder) == "".join(byte_encoder[b] for b in word.encode("utf-8"))
+    corpora = {args.file: text, "ASCII only": text.encode("ascii", "ignore").decode()}
+    for name, sentences in SENTENCES.items():
+        corpora[name] = make_corpus(sentences, args.num_sentences, args.seed)
+    print(f"{'corpus':>16} {'chars':>8} {'findall (ms)':>13} {'iter_pre_tokenize (ms)':>23}")
+    for name, corpus in corpora.items():
+        assert list(iter_pre_tokenize(corpus)) == UNICODE_PATTERN.findall(corpus)
+        times = []
+        for fn in [UNICODE_PATTERN.findall, lambda corpus: list(iter_pre_tokenize(corpus))]:
+            best = float("inf")
+            for _ in range(5):
+                start = time.perf_counter()
+                fn(corpus)
+                best = min(best, time.perf_counter() - start)
+            times.append(best * 1000)
+        print(f"{name:>16} {len(corpus):8d} {times[0]:13.2f} {times[1]:23.2f}")
+    start = time.perf_counter()
+    joined = ["".join([byte_encoder[b] for b in word.encode("utf-8")]) for word in words]
+    join_time = time.perf_counter() - start
+    start = time.perf_counter()
+    translated = [word.encode("utf-8").decode("latin-1").translate(byte_encoder) for word in words]
+    translate_time = time.perf_counter() - start
+    print(f"byte -> unicode for {len(words)} words: join {join_time * 1000:.2f} ms, translate {translate_time * 1000:.2f} ms")
@@ -0,0 +1,91 @@
+"""
+Opt-in per-stage profiling for `MySlowTokenizer.encode`. See `MySlowTokenizer.profile`.
+"""
+import heapq
+from typing import Dict, List, Tuple
+
+# Stages of `encode`, in order
+STAGES = (
+    "split", # splitting on added tokens
+    "pre_tokenize", # regex pre-tokenization
+    "byte_encode", # utf-8 encoding of each word
+    "cache", # word cache lookups
+    "bpe", # BPE merges, for words not in the cache
+    "added_tokens", # id lookup for added tokens
+)
+
+
+class EncodeProfiler:
+    """
+    Collects cumulative time, call counts and bytes/tokens handled for each stage of `encode`, along with the
+    `top_n` most expensive words seen by the BPE stage.
+    """
+    def __init__(self, top_n: int = 10):
+        self.top_n = top_n
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.calls = dict.fromkeys(STAGES, 0)
+        self.bytes = dict.fromkeys(STAGES, 0) # input size of the stage
+        self.tokens = dict.fromkeys(STAGES, 0) # output size of the stage: chunks, words or token ids
+        self._slowest = [] # min-heap of (seconds, word) with the `top_n` slowest BPE calls
+
+    def record(self, stage: str, seconds: float, num_bytes: int = 0, num_tokens: int = 0):
+        self.seconds[stage] += seconds
+        self.calls[stage] += 1
+        self.bytes[stage] += num_bytes
+        self.tokens[stage] += num_tokens
+
+    def record_word(self, word: bytes, seconds: float):
+        if len(self._slowest) < self.top_n:
+            heapq.heappush(self._slowest, (seconds, word))
+        elif seconds > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (seconds, word))
+
+    def merge(self, other: "EncodeProfiler"):
+        """
+        Adds the counters and slowest words of another profiler, ex: one from a pool worker.
+        """
+        for stage in STAGES:
+            self.seconds[stage] += other.seconds[stage]
+            self.calls[stage] += other.calls[stage]
+            self.bytes[stage] += other.bytes[stage]
+            self.tokens[stage] += other.tokens[stage]
+        for seconds, word in other._slowest:
+            self.record_word(word, seconds)
+
+    def top_words(self) -> List[Tuple[str, float]]:
+        """
+        The most expensive words for BPE, slowest first, as (word, seconds).
+        """
+        return [(word.decode("utf-8", "replace"), seconds) for seconds, word in sorted(self._slowest, reverse=True)]
+
+    def to_dict(self) -> Dict:
+        return {
+            "stages": {
+                stage: {"seconds": self.seconds[stage], "calls": self.calls[stage], "bytes": self.bytes[stage], "tokens": self.tokens[stage]}
+                for stage in STAGES
+            },
+            "top_words": [{"word": word, "seconds": seconds} for word, seconds in self.top_words()],
+        }
+
+    def to_prometheus(self, prefix: str = "tokenizer_encode") -> str:
+        """
+        Prometheus text exposition format, one counter per metric with a `stage` label.
+        """
+        lines = []
+        metrics = [
+            ("seconds_total", "Cumulative time spent in each stage of encode", self.seconds),
+            ("calls_total", "Number of calls to each stage of encode", self.calls),
+            ("bytes_total", "Bytes of input handled by each stage of encode", self.bytes),
+            ("tokens_total", "Chunks, words or token ids produced by each stage of encode", self.tokens),
+        ]
+        for name, description, values in metrics:
+            lines.append(f"# HELP {prefix}_{name} {description}")
+            lines.append(f"# TYPE {prefix}_{name} counter")
+            for stage in STAGES:
+                lines.append(f'{prefix}_{name}{{stage="{stage}"}} {values[stage]}')
+        return "\n".join(lines) + "\n"
+
+    def __repr__(self) -> str:
+        total = sum(self.seconds.values()) or 1.0
+        stages = ", ".join(f"{stage}={self.seconds[stage] / total:.0%}" for stage in STAGES)
+        return f"EncodeProfiler({stages})"
@@ -0,0 +1,109 @@
+"""
+Ragged batches of token ids: every id of the batch in one flat NumPy array, plus an offsets array.
+Document i is `ids[offsets[i]:offsets[i + 1]]`. See `MySlowTokenizer.encode_batch_ragged`.
+
+Ids are written into a growable `array.array` while encoding (uint16 if the vocab fits, else uint32), and the NumPy
+arrays are views over it, so there is no list of ints per document and nothing is copied at the end.
+Run `python ragged.py` to check a batch against `encode`/`decode`.
+"""
+from array import array
+from typing import List, Tuple
+import numpy as np
+
+
+class RaggedIds:
+    """
+    A batch of token id sequences of different lengths, stored flat.
+    Indexing returns a view into `ids`, ex: `batch[3]` is the ids of the fourth document without a copy.
+    """
+    def __init__(self, ids: np.ndarray, offsets: np.ndarray):
+        self.ids = ids
+        self.offsets = offsets # int64, len(batch) + 1 entries, starts at 0
+
+    @classmethod
+    def from_buffers(cls, ids: array, lengths: array) -> "RaggedIds":
+        """
+        Wraps an `array` of ids and an `array("q")` of document lengths. The ids are not copied: don't grow `ids` afterwards.
+        """
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        if len(lengths):
+            np.cumsum(np.frombuffer(lengths, dtype=np.int64), out=offsets[1:])
+        dtype = np.dtype(ids.typecode)
+        return cls(np.frombuffer(ids, dtype=dtype) if len(ids) else np.zeros(0, dtype=dtype), offsets)
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def tolist(self) -> List[List[int]]:
+        return [self[i].tolist() for i in range(len(self))]
+
+    def pack(self, block_size: int, eos_id: int, drop_last: bool = True) -> np.ndarray:
+        """
+        Concatenates all documents, each followed by `eos_id`, and cuts the result into rows of `block_size` ids.
+        The last partial block is dropped, or filled with `eos_id` if `drop_last=False`.
+        Returns a (num_blocks, block_size) view of a single contiguous buffer.
+        """
+        num_docs, num_ids = len(self), len(self.ids)
+        total = num_ids + num_docs
+        num_blocks = total // block_size if drop_last else -(-total // block_size)
+        packed = np.full(num_blocks * block_size if not drop_last else total, eos_id, dtype=self.ids.dtype)
+        # document i moves right by i positions, to make room for the EOS tokens before it
+        shift = np.repeat(np.arange(num_docs, dtype=np.int64), self.lengths)
+        packed[np.arange(num_ids, dtype=np.int64) + shift] = self.ids
+        return packed[:num_blocks * block_size].reshape(num_blocks, block_size)
+
+    def pad(self, pad_id: int, max_length: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Pads (right side) to the longest document, or truncates/pads to `max_length`.
+        Returns (input_ids, attention_mask), both of shape (len(batch), length), with 1 in the mask for real tokens.
+        """
+        lengths = self.lengths
+        if max_length is None:
+            max_length = int(lengths.max()) if len(lengths) else 0
+        kept = np.minimum(lengths, max_length)
+        attention_mask = (np.arange(max_length) < kept[:, None]).astype(np.uint8)
+        input_ids = np.full((len(self), max_length), pad_id, dtype=self.ids.dtype)
+        if (kept == lengths).all():
+            source = self.ids
+        else:
+            # position of each id inside its document, to drop the truncated ones
+            position = np.arange(len(self.ids), dtype=np.int64) - np.repeat(self.offsets[:-1], lengths)
+            source = self.ids[position < max_length]
+        input_ids[attention_mask.astype(bool)] = source
+        return input_ids, attention_mask
+
+    def __repr__(self) -> str:
+        return f"RaggedIds(num_docs={len(self)}, num_ids={len(self.ids)}, dtype={self.ids.dtype})"
+
+
+if __name__ == "__main__":
+    # Checks a ragged batch against `encode`, and that its rows (NumPy views) go back through `decode`
+    from minimal_hf_tok import EOS_TOKEN, MySlowTokenizer
+    tokenizer = MySlowTokenizer("vocab.json")
+    with open("README.md", "r", encoding="utf-8") as f:
+        docs = [doc for doc in f.read().split("\n\n") if doc][:200] + ["", "🤗 café"]
+    batch = tokenizer.encode_batch_ragged(docs)
+    assert batch.tolist() == [tokenizer.encode(doc) for doc in docs], "ragged batch differs from encode"
+    for i, doc in enumerate(docs):
+        assert tokenizer.decode(batch[i]) == doc, f"decoding row {i} of the batch gives a different text"
+    eos_id = tokenizer.convert_token_to_id(EOS_TOKEN)
+    packed = batch.pack(block_size=64, eos_id=eos_id, drop_last=False)
+    # every document followed by EOS, then EOS to fill the last block
+    expected = "".join(doc + EOS_TOKEN for doc in docs)
+    decoded = tokenizer.decode(packed.reshape(-1))
+    assert decoded.startswith(expected) and decoded[len(expected):] == EOS_TOKEN * ((len(decoded) - len(expected)) // len(EOS_TOKEN)), "packed batch decodes to a different text"
+    input_ids, attention_mask = batch.pad(pad_id=eos_id)
+    for i, doc in enumerate(docs):
+        assert tokenizer.decode(input_ids[i][attention_mask[i].astype(bool)]) == doc, f"padded row {i} decodes to a different text"
+    print(f"{batch}: rows, packed and padded rows match encode/decode for {len(docs)} documents")
@@ -0,0 +1,266 @@
+"""
+Pre-tokenized shards: tokenize a corpus once, then re-read the token ids from disk as often as needed.
+
+`tokenize-to-shards` reads documents from .jsonl files (one document per line, under `--text_key`) or plain text files
+(one document per file), and cuts them into shards of `--docs_per_shard` documents, in input order. Each shard is
+tokenized by one worker and written as two files:
+    shard_00000.bin     the token ids of all its documents, back to back (uint16, or uint32 for big vocabs)
+    shard_00000.idx     one (offset, length, source, record) entry per document, as int64. `offset` and `length` are in
+                        tokens, `source` is the index of the input file in `meta.json` and `record` the line number
+meta.json holds the settings (including a hash of the vocab and added tokens), the list of input files and, once
+everything is written, the totals.
+
+Shards are written to temporary files and renamed when complete, the index last. If the run crashes, running the
+same command again skips the shards that are already there. Which document goes to which shard only depends on
+`--docs_per_shard`, so the output is byte-for-byte the same for any number of workers.
+
+`ShardReader` memory-maps the shards: document i is a view into the mmap (no copy, no tokenization), and
+`iter_blocks`/`sample_blocks` return fixed-size windows of the token stream for training.
+Usage:
+    python shards.py tokenize-to-shards essays.jsonl --output_dir shards --num_workers 8 --append_eos
+    python shards.py read shards
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator, List, Tuple
+import numpy as np
+import minimal_hf_tok
+from minimal_hf_tok import EOS_TOKEN, MySlowTokenizer
+
+FORMAT_VERSION = 1
+INDEX_DTYPE = np.dtype([("offset", "<i8"), ("length", "<i8"), ("source", "<i8"), ("record", "<i8")])
+META_FILE = "meta.json"
+
+
+def shard_paths(output_dir: str, shard_index: int) -> Tuple[str, str]:
+    prefix = os.path.join(output_dir, f"shard_{shard_index:05d}")
+    return prefix + ".bin", prefix + ".idx"
+
+
+def vocab_hash(vocab_file: str, tokenizer: MySlowTokenizer) -> str:
+    """
+    sha256 of the vocab file's content and of the tokens the tokenizer splits on. A path isn't enough to resume: the
+    file may have been edited or replaced since.
+    """
+    digest = hashlib.sha256()
+    with open(vocab_file, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    digest.update(json.dumps(sorted(tokenizer.added_tokens_trie._tokens)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def read_documents(sources: List[str], text_key: str = "text") -> Iterator[Tuple[str, int, int]]:
+    """
+    Yields (text, source index, record number) for every document, in input order.
+    """
+    for source, path in enumerate(sources):
+        if path.endswith(".jsonl"):
+            with open(path, "r", encoding="utf-8") as f:
+                for record, line in enumerate(f):
+                    if line.strip():
+                        yield json.loads(line)[text_key], source, record
+        else:
+            with open(path, "r", encoding="utf-8") as f:
+                yield f.read(), source, 0
+
+
+def _write_shard(output_dir: str, shard_index: int, typecode: str, eos_id: int, documents: List[Tuple[str, int, int]], tokenizer: MySlowTokenizer = None) -> int:
+    # runs in a pool worker (see `minimal_hf_tok._init_worker`), or in this process if `tokenizer` is given
+    tokenizer = tokenizer or minimal_hf_tok._worker_tokenizer
+    ids = array(typecode)
+    index = np.zeros(len(documents), dtype=INDEX_DTYPE)
+    scratch = []
+    for k, (text, source, record) in enumerate(documents):
+        scratch.clear()
+        tokenizer._encode_into(tokenizer.prepare_for_tokenization(text)[0], scratch)
+        if eos_id is not None:
+            scratch.append(eos_id)
+        index[k] = (len(ids), len(scratch), source, record)
+        ids.fromlist(scratch)
+    bin_path, idx_path = shard_paths(output_dir, shard_index)
+    # write both files under temporary names, then rename: the index is renamed last and marks the shard as done
+    with open(bin_path + ".tmp", "wb") as f:
+        ids.tofile(f)
+    with open(idx_path + ".tmp", "wb") as f:
+        index.tofile(f)
+    os.replace(bin_path + ".tmp", bin_path)
+    os.replace(idx_path + ".tmp", idx_path)
+    return len(ids)
+
+
+def tokenize_to_shards(sources: List[str], output_dir: str, vocab_file: str = "vocab.json", num_workers: int = 0,
+                       docs_per_shard: int = 10000, text_key: str = "text", append_eos: bool = False) -> dict:
+    """
+    Tokenizes `sources` into shards in `output_dir`, skipping shards written by a previous run. Returns the metadata.
+    """
+    tokenizer = MySlowTokenizer(vocab_file)
+    typecode = tokenizer.id_typecode
+    settings = {
+        "format_version": FORMAT_VERSION,
+        "vocab_hash": vocab_hash(vocab_file, tokenizer),
+        "dtype": np.dtype(typecode).name,
+        "docs_per_shard": docs_per_shard,
+        "text_key": text_key,
+        "eos_id": tokenizer.convert_token_to_id(EOS_TOKEN) if append_eos else None,
+        "sources": [os.path.abspath(path) for path in sources],
+    }
+    os.makedirs(output_dir, exist_ok=True)
+    meta_path = os.path.join(output_dir, META_FILE)
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            previous = json.load(f)
+        changed = [key for key in settings if previous.get(key) != settings[key]]
+        if changed:
+            raise ValueError(f"{output_dir} holds shards written with different settings ({', '.join(changed)}), use another output_dir")
+    settings["vocab_file"] = os.path.abspath(vocab_file) # for information only, the hash is what's checked
+    with open(meta_path, "w") as f:
+        json.dump(settings, f, indent=2)
+
+    pool = ProcessPoolExecutor(num_workers, initializer=minimal_hf_tok._init_worker, initargs=(vocab_file, tokenizer.bpe.merge_engine, tokenizer.cache.maxsize, tokenizer.splitter, [])) if num_workers > 0 else None
+    pending = []
+    num_shards, num_docs, skipped = 0, 0, 0
+    documents = []
+
+    def submit(shard_index, documents):
+        if os.path.exists(shard_paths(output_dir, shard_index)[1]):
+            return 1 # already written by a previous run
+        if pool is None:
+            _write_shard(output_dir, shard_index, typecode, settings["eos_id"], documents, tokenizer)
+        else:
+            pending.append(pool.submit(_write_shard, output_dir, shard_index, typecode, settings["eos_id"], documents))
+            if len(pending) >= 2 * num_workers: # backpressure: don't read the whole corpus into memory
+                pending.pop(0).result()
+        return 0
+
+    try:
+        for document in read_documents(sources, text_key):
+            documents.append(document)
+            num_docs += 1
+            if len(documents) == docs_per_shard:
+                skipped += submit(num_shards, documents)
+                num_shards, documents = num_shards + 1, []
+        if documents:
+            skipped += submit(num_shards, documents)
+            num_shards += 1
+        for future in pending:
+            future.result()
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    num_tokens = sum(os.path.getsize(shard_paths(output_dir, k)[0]) for k in range(num_shards)) // np.dtype(typecode).itemsize
+    meta = {**settings, "num_shards": num_shards, "num_docs": num_docs, "num_tokens": num_tokens}
+    with open(meta_path + ".tmp", "w") as f:
+        json.dump(meta, f, indent=2)
+    os.replace(meta_path + ".tmp", meta_path)
+    print(f"Wrote {num_shards - skipped} shard(s), skipped {skipped} already written. {num_docs:,} documents, {num_tokens:,} tokens")
+    return meta
+
+
+class ShardReader:
+    """
+    Memory-mapped, read-only access to the output of `tokenize_to_shards`.
+    `reader[i]` returns the ids of document i as a NumPy view into the mmap.
+    """
+    def __init__(self, output_dir: str):
+        with open(os.path.join(output_dir, META_FILE)) as f:
+            self.meta = json.load(f)
+        if "num_shards" not in self.meta:
+            raise ValueError(f"{output_dir} is incomplete, run tokenize-to-shards again to finish it")
+        dtype = np.dtype(self.meta["dtype"])
+        self.docs_per_shard = self.meta["docs_per_shard"]
+        self.shards, self.indices = [], []
+        for shard_index in range(self.meta["num_shards"]):
+            bin_path, idx_path = shard_paths(output_dir, shard_index)
+            # np.memmap can't map empty files
+            self.shards.append(np.memmap(bin_path, dtype=dtype, mode="r") if os.path.getsize(bin_path) else np.zeros(0, dtype=dtype))
+            self.indices.append(np.memmap(idx_path, dtype=INDEX_DTYPE, mode="r"))
+
+    def __len__(self) -> int:
+        return self.meta["num_docs"]
+
+    def __getitem__(self, doc_index: int) -> np.ndarray:
+        if doc_index < 0:
+            doc_index += len(self)
+        if not 0 <= doc_index < len(self):
+            raise IndexError(doc_index)
+        # every shard but the last has exactly `docs_per_shard` documents
+        shard_index, position = divmod(doc_index, self.docs_per_shard)
+        entry = self.indices[shard_index][position]
+        offset, length = int(entry["offset"]), int(entry["length"])
+        return self.shards[shard_index][offset:offset + length]
+
+    def source(self, doc_index: int) -> Tuple[str, int]:
+        """
+        (input file, line number) of a document.
+        """
+        if doc_index < 0:
+            doc_index += len(self)
+        shard_index, position = divmod(doc_index, self.docs_per_shard)
+        entry = self.indices[shard_index][position]
+        return self.meta["sources"][entry["source"]], int(entry["record"])
+
+    def iter_blocks(self, block_size: int) -> Iterator[np.ndarray]:
+        """
+        Yields consecutive `block_size` windows of each shard's token stream, in order. The tail of a shard is dropped.
+        """
+        for shard in self.shards:
+            for start in range(0, len(shard) - block_size + 1, block_size):
+                yield shard[start:start + block_size]
+
+    def sample_blocks(self, block_size: int, num_blocks: int, seed: int = 0) -> np.ndarray:
+        """
+        `num_blocks` windows of `block_size` tokens starting at random positions, shards picked proportionally to
+        their size. Returns a (num_blocks, block_size) array.
+        """
+        rng = random.Random(seed)
+        candidates = [k for k, shard in enumerate(self.shards) if len(shard) >= block_size]
+        if not candidates:
+            raise ValueError(f"No shard has {block_size} tokens")
+        weights = [len(self.shards[k]) - block_size + 1 for k in candidates]
+        blocks = np.empty((num_blocks, block_size), dtype=self.shards[candidates[0]].dtype)
+        for row, shard_index in enumerate(rng.choices(candidates, weights=weights, k=num_blocks)):
+            start = rng.randrange(len(self.shards[shard_index]) - block_size + 1)
+            blocks[row] = self.shards[shard_index][start:start + block_size]
+        return blocks
+
+    def __repr__(self) -> str:
+        return f"ShardReader(num_shards={len(self.shards)}, num_docs={len(self)}, num_tokens={self.meta['num_tokens']}, dtype={self.meta['dtype']})"
+
+
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers(dest="command", required=True)
+tokenize_parser = subparsers.add_parser("tokenize-to-shards", help="Tokenize documents into binary shards")
+tokenize_parser.add_argument("sources", type=str, nargs="+", help=".jsonl files (one document per line) or text files (one document per file)")
+tokenize_parser.add_argument("--output_dir", type=str, required=True)
+tokenize_parser.add_argument("--vocab_file", type=str, default="vocab.json")
+tokenize_parser.add_argument("--num_workers", type=int, default=0, help="0 tokenizes in this process")
+tokenize_parser.add_argument("--docs_per_shard", type=int, default=10000)
+tokenize_parser.add_argument("--text_key", type=str, default="text")
+tokenize_parser.add_argument("--append_eos", action="store_true", help=f"End every document with {EOS_TOKEN}")
+read_parser = subparsers.add_parser("read", help="Read all documents back and report the throughput")
+read_parser.add_argument("output_dir", type=str)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.command == "tokenize-to-shards":
+        start = time.perf_counter()
+        tokenize_to_shards(args.sources, args.output_dir, args.vocab_file, args.num_workers, args.docs_per_shard, args.text_key, args.append_eos)
+        print(f"Took {time.perf_counter() - start:.1f}s")
+    else:
+        reader = ShardReader(args.output_dir)
+        print(reader)
+        start = time.perf_counter()
+        num_tokens = checksum = 0
+        for doc_index in range(len(reader)):
+            ids = reader[doc_index]
+            num_tokens += len(ids)
+            checksum += int(ids.sum(dtype=np.int64)) # make sure every page is actually read
+        elapsed = time.perf_counter() - start
+        print(f"Read {len(reader):,} documents, {num_tokens:,} tokens in {elapsed:.2f}s ({num_tokens / max(elapsed, 1e-9) / 1e6:.1f}M tokens/s)")
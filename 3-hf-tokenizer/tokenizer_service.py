@@ -0,0 +1,393 @@
+"""
+A local asyncio tokenization service around `MySlowTokenizer`, with micro-batching.
+
+Instead of every service loading its own tokenizer and encoding one request at a time, clients send requests to this
+server. Concurrent requests are queued and grouped into micro-batches: a batch is sent to the tokenizer as soon as it
+has `--max_batch_size` requests, or when the oldest request has waited `--max_wait_ms` (the latency budget). Batches
+go through `encode_batch`/`decode_batch`/`count_tokens_batch`, so `--backend process --num_workers N` spreads them
+over a process pool. When more than `--max_queue` requests are waiting, new ones are rejected right away with an
+"overloaded" error instead of piling up (backpressure).
+
+Protocol: one JSON object per line, over TCP or a Unix socket. Responses carry the `id` of their request, and can
+come back out of order when requests are pipelined.
+    {"id": 1, "op": "encode", "text": "Hello world"}   ->  {"id": 1, "ids": [15496, 995]}
+    {"id": 2, "op": "decode", "ids": [15496, 995]}     ->  {"id": 2, "text": "Hello world"}
+    {"id": 3, "op": "count", "text": "Hello world"}    ->  {"id": 3, "count": 2}
+    {"id": 4, "op": "stats"}                           ->  {"id": 4, "stats": {...}} queue depth, batch sizes, latencies
+    {"id": 5, "op": "metrics"}                         ->  {"id": 5, "metrics": "..."} same, in Prometheus text format
+Usage:
+    python tokenizer_service.py serve --unix_socket /tmp/tokenizer.sock --backend process --num_workers 4
+    python tokenizer_service.py loadgen --unix_socket /tmp/tokenizer.sock --rates 100 500 1000 2000
+"""
+import argparse
+import asyncio
+import bisect
+import itertools
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Tuple
+from minimal_hf_tok import MySlowTokenizer
+
+OPS = ("encode", "decode", "count")
+LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+STREAM_LIMIT = 2**26 # max size of a request line
+
+
+class Overloaded(Exception):
+    pass
+
+
+class Histogram:
+    """
+    Cumulative histogram with fixed bucket upper bounds, like a Prometheus histogram.
+    """
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket holding the q-quantile (inf if it's in the last bucket).
+        """
+        rank = q * self.count
+        for bound, cumulative in zip(self.buckets + (float("inf"),), itertools.accumulate(self.counts)):
+            if cumulative >= rank:
+                return bound
+        return float("inf")
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "buckets": {str(bound): count for bound, count in zip(self.buckets + ("+Inf",), itertools.accumulate(self.counts))},
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+        }
+
+    def to_prometheus(self, name: str, labels: str = "") -> List[str]:
+        separator, label_set = (",", f"{{{labels}}}") if labels else ("", "")
+        lines = []
+        for bound, cumulative in zip(self.buckets + ("+Inf",), itertools.accumulate(self.counts)):
+            lines.append(f'{name}_bucket{{{labels}{separator}le="{bound}"}} {cumulative}')
+        lines.append(f"{name}_sum{label_set} {self.sum}")
+        lines.append(f"{name}_count{label_set} {self.count}")
+        return lines
+
+
+class MicroBatcher:
+    """
+    Queues requests and runs them through the tokenizer in batches. Batches run one at a time in a background
+    thread, while the next batch fills up.
+    """
+    def __init__(self, tokenizer: MySlowTokenizer, max_batch_size: int = 64, max_wait_ms: float = 2.0, max_queue: int = 4096,
+                 backend: str = "serial", num_workers: int = None):
+        self.tokenizer = tokenizer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.backend = backend
+        self.num_workers = num_workers
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=1) # keeps the event loop free while a batch is tokenized
+        self.batch_fns = {
+            "encode": tokenizer.encode_batch,
+            "decode": tokenizer.decode_batch,
+            "count": tokenizer.count_tokens_batch,
+        }
+        # metrics
+        self.latency_ms = {op: Histogram(LATENCY_BUCKETS_MS) for op in OPS} # from arrival to response
+        self.queue_wait_ms = Histogram(LATENCY_BUCKETS_MS) # from arrival to the start of its batch
+        self.batch_size = Histogram(BATCH_SIZE_BUCKETS)
+        self.requests = dict.fromkeys(OPS, 0)
+        self.rejected = 0
+        self.errors = 0
+        self.max_queue_depth = 0
+
+    async def submit(self, op: str, payload: Any) -> Any:
+        """
+        Queues one request and waits for its result. Raises `Overloaded` if the queue is full.
+        """
+        if self.queue.qsize() >= self.max_queue:
+            self.rejected += 1
+            raise Overloaded(f"more than {self.max_queue} requests waiting")
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((op, payload, future, time.perf_counter()))
+        self.requests[op] += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # a `queue.get()` that timed out is kept for the next batch instead of being cancelled: on Python 3.11,
+        # `wait_for` can cancel a get that already took a request off the queue, and that request is lost
+        get = None
+        try:
+            while True:
+                if get is None:
+                    get = asyncio.ensure_future(self.queue.get())
+                batch = [await get]
+                get = None
+                # the latency budget starts when the oldest request arrived, which may already be a while ago
+                deadline = batch[0][3] + self.max_wait
+                while len(batch) < self.max_batch_size:
+                    if not self.queue.empty():
+                        batch.append(self.queue.get_nowait())
+                        continue
+                    timeout = deadline - time.perf_counter()
+                    if timeout <= 0:
+                        break
+                    get = asyncio.ensure_future(self.queue.get())
+                    done, _ = await asyncio.wait({get}, timeout=timeout)
+                    if not done:
+                        break # `get` stays pending, the request it takes starts the next batch
+                    batch.append(get.result())
+                    get = None
+                await self._run_requests(loop, batch)
+        finally:
+            if get is not None:
+                get.cancel()
+
+    async def _run_requests(self, loop: asyncio.AbstractEventLoop, batch: List[Tuple]):
+        start = time.perf_counter()
+        self.batch_size.observe(len(batch))
+        for _, _, _, arrival in batch:
+            self.queue_wait_ms.observe((start - arrival) * 1000)
+        for op in OPS:
+            requests = [request for request in batch if request[0] == op]
+            if not requests:
+                continue
+            results = await loop.run_in_executor(self.executor, self._run_batch, op, [payload for _, payload, _, _ in requests])
+            done = time.perf_counter()
+            for (_, _, future, arrival), result in zip(requests, results):
+                self.latency_ms[op].observe((done - arrival) * 1000)
+                if future.cancelled():
+                    continue # the client went away
+                if isinstance(result, Exception):
+                    self.errors += 1
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _run_batch(self, op: str, payloads: List[Any]) -> List[Any]:
+        try:
+            return self.batch_fns[op](payloads, backend=self.backend, num_workers=self.num_workers)
+        except Exception:
+            # one bad request shouldn't fail its whole batch: retry one by one, and return the errors as results
+            results = []
+            for payload in payloads:
+                try:
+                    results.append(self.batch_fns[op]([payload])[0])
+                except Exception as error:
+                    results.append(error)
+            return results
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": self.queue.qsize(),
+            "max_queue_depth": self.max_queue_depth,
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "batch_size": self.batch_size.to_dict(),
+            "queue_wait_ms": self.queue_wait_ms.to_dict(),
+            "latency_ms": {op: histogram.to_dict() for op, histogram in self.latency_ms.items()},
+        }
+
+    def to_prometheus(self, prefix: str = "tokenizer_service") -> str:
+        lines = [
+            f"# TYPE {prefix}_queue_depth gauge", f"{prefix}_queue_depth {self.queue.qsize()}",
+            f"# TYPE {prefix}_rejected_total counter", f"{prefix}_rejected_total {self.rejected}",
+            f"# TYPE {prefix}_errors_total counter", f"{prefix}_errors_total {self.errors}",
+            f"# TYPE {prefix}_requests_total counter",
+        ]
+        lines.extend(f'{prefix}_requests_total{{op="{op}"}} {count}' for op, count in self.requests.items())
+        lines.append(f"# TYPE {prefix}_batch_size histogram")
+        lines.extend(self.batch_size.to_prometheus(f"{prefix}_batch_size"))
+        lines.append(f"# TYPE {prefix}_queue_wait_ms histogram")
+        lines.extend(self.queue_wait_ms.to_prometheus(f"{prefix}_queue_wait_ms"))
+        lines.append(f"# TYPE {prefix}_latency_ms histogram")
+        for op, histogram in self.latency_ms.items():
+            lines.extend(histogram.to_prometheus(f"{prefix}_latency_ms", f'op="{op}"'))
+        return "\n".join(lines) + "\n"
+
+
+class TokenizerService:
+    """
+    Reads JSON lines from clients and answers each request once its batch is done.
+    """
+    def __init__(self, batcher: MicroBatcher):
+        self.batcher = batcher
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # requests of a connection are handled concurrently, so that pipelined requests share batches
+                task = asyncio.ensure_future(self.handle_request(line, writer))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.wait(tasks)
+        finally:
+            writer.close()
+
+    async def handle_request(self, line: bytes, writer: asyncio.StreamWriter):
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            op = request.get("op")
+            if op == "encode":
+                response = {"ids": await self.batcher.submit(op, request["text"])}
+            elif op == "decode":
+                response = {"text": await self.batcher.submit(op, request["ids"])}
+            elif op == "count":
+                response = {"count": await self.batcher.submit(op, request["text"])}
+            elif op == "stats":
+                response = {"stats": self.batcher.stats()}
+            elif op == "metrics":
+                response = {"metrics": self.batcher.to_prometheus()}
+            else:
+                raise ValueError(f"op should be one of {OPS + ('stats', 'metrics')}, got {op}")
+        except Overloaded as error:
+            response = {"error": "overloaded", "detail": str(error)}
+        except Exception as error:
+            response = {"error": type(error).__name__, "detail": str(error)}
+        response["id"] = request_id
+        writer.write(json.dumps(response).encode("utf-8") + b"\n")
+        await writer.drain()
+
+
+async def serve(args):
+    tokenizer = MySlowTokenizer(args.vocab_file, merge_engine=args.merge_engine)
+    batcher = MicroBatcher(tokenizer, args.max_batch_size, args.max_wait_ms, args.max_queue, args.backend, args.num_workers)
+    if args.backend != "serial":
+        # start the pool now, so that the first requests don't pay for it
+        tokenizer.encode_batch(["warm up"] * (args.num_workers or 1), backend=args.backend, num_workers=args.num_workers)
+    service = TokenizerService(batcher)
+    if args.unix_socket:
+        server = await asyncio.start_unix_server(service.handle_connection, path=args.unix_socket, limit=STREAM_LIMIT)
+        address = args.unix_socket
+    else:
+        server = await asyncio.start_server(service.handle_connection, args.host, args.port, limit=STREAM_LIMIT)
+        address = f"{args.host}:{args.port}"
+    print(f"Serving on {address} (max batch size {args.max_batch_size}, latency budget {args.max_wait_ms} ms, backend {args.backend})", flush=True)
+    batching = asyncio.ensure_future(batcher.run())
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batching.cancel()
+        tokenizer.close()
+
+
+async def open_connection(args) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+    if args.unix_socket:
+        return await asyncio.open_unix_connection(args.unix_socket, limit=STREAM_LIMIT)
+    return await asyncio.open_connection(args.host, args.port, limit=STREAM_LIMIT)
+
+
+async def run_load(args, rate: float, texts: List[str]) -> Dict[str, float]:
+    """
+    Open-loop load: requests are sent at Poisson arrival times at `rate` per second, regardless of how fast responses
+    come back, so that queueing shows up in the latencies.
+    """
+    rng = random.Random(args.seed)
+    connections = [await open_connection(args) for _ in range(args.connections)]
+    pending = {} # request id -> send time
+    latencies, errors = [], 0
+
+    async def read_responses(reader):
+        nonlocal errors
+        while True:
+            line = await reader.readline()
+            if not line:
+                return
+            response = json.loads(line)
+            sent = pending.pop(response.get("id"), None)
+            if sent is None or "error" in response:
+                # errors for requests the server couldn't read have no id
+                errors += 1
+            else:
+                latencies.append(time.perf_counter() - sent)
+
+    readers = [asyncio.ensure_future(read_responses(reader)) for reader, _ in connections]
+    start = time.perf_counter()
+    next_send = start
+    request_ids = itertools.count()
+    while next_send - start < args.duration:
+        await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+        request_id = next(request_ids)
+        _, writer = connections[request_id % len(connections)]
+        pending[request_id] = time.perf_counter()
+        writer.write(json.dumps({"id": request_id, "op": args.op, "text": rng.choice(texts)}).encode("utf-8") + b"\n")
+        next_send += rng.expovariate(rate)
+    # wait for the stragglers
+    while pending and time.perf_counter() - start < args.duration + args.timeout:
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    for reader_task in readers:
+        reader_task.cancel()
+    for _, writer in connections:
+        writer.close()
+    latencies.sort()
+    def percentile(q):
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000 if latencies else float("nan")
+    return {"rate": rate, "sent": next(request_ids), "throughput": len(latencies) / elapsed, "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99), "errors": errors, "timed_out": len(pending)}
+
+
+async def loadgen(args):
+    with open(args.file, "r", encoding="utf-8") as f:
+        texts = [paragraph for paragraph in f.read().split("\n\n") if paragraph.strip()]
+    print(f"{'target req/s':>12} {'sent':>7} {'done req/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7} {'timed out':>9}")
+    for rate in args.rates:
+        result = await run_load(args, rate, texts)
+        print(f"{rate:12.0f} {result['sent']:7d} {result['throughput']:10.1f} {result['p50_ms']:8.2f} {result['p99_ms']:8.2f} {result['errors']:7d} {result['timed_out']:9d}")
+    reader, writer = await open_connection(args)
+    writer.write(b'{"id": "stats", "op": "stats"}\n')
+    stats = json.loads(await reader.readline())["stats"]
+    writer.close()
+    print(f"Server: {sum(stats['requests'].values())} requests, {stats['rejected']} rejected, max queue depth {stats['max_queue_depth']}, "
+          f"mean batch size {stats['batch_size']['sum'] / max(stats['batch_size']['count'], 1):.1f}")
+
+
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers(dest="command", required=True)
+serve_parser = subparsers.add_parser("serve", help="Run the tokenization service")
+serve_parser.add_argument("--vocab_file", type=str, default="vocab.json")
+serve_parser.add_argument("--merge_engine", type=str, default="loop")
+serve_parser.add_argument("--max_batch_size", type=int, default=64)
+serve_parser.add_argument("--max_wait_ms", type=float, default=2.0, help="Latency budget: how long a request can wait for its batch to fill up")
+serve_parser.add_argument("--max_queue", type=int, default=4096, help="Reject new requests when this many are waiting")
+serve_parser.add_argument("--backend", type=str, default="serial", choices=["serial", "thread", "process"])
+serve_parser.add_argument("--num_workers", type=int, default=None)
+loadgen_parser = subparsers.add_parser("loadgen", help="Measure latency against throughput on a running service")
+loadgen_parser.add_argument("--rates", type=float, nargs="+", default=[100, 200, 500, 1000, 2000], help="Target requests per second")
+loadgen_parser.add_argument("--duration", type=float, default=5.0, help="Seconds per rate")
+loadgen_parser.add_argument("--timeout", type=float, default=10.0, help="Extra seconds to wait for responses")
+loadgen_parser.add_argument("--connections", type=int, default=8)
+loadgen_parser.add_argument("--op", type=str, default="encode", choices=["encode", "count"])
+loadgen_parser.add_argument("--file", type=str, default="README.md", help="Each paragraph of this file is a request")
+loadgen_parser.add_argument("--seed", type=int, default=0)
+for subparser in (serve_parser, loadgen_parser):
+    subparser.add_argument("--unix_socket", type=str, default=None, help="Use this Unix socket instead of TCP")
+    subparser.add_argument("--host", type=str, default="127.0.0.1")
+    subparser.add_argument("--port", type=int, default=8765)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    asyncio.run(serve(args) if args.command == "serve" else loadgen(args))
@@ -12,13 +12,14 @@ class Tokenizers:
     falcon_tokenizer: AutoTokenizer
 
 def tokenized_lengths(examples, tokenizers: Tokenizers):
-    examples["gpt2_length"] = [len(t) for t in tokenizers.gpt2_tokenizer(examples["content"])["input_ids"]]
+    # no need for attention masks, we only want lengths
+    examples["gpt2_length"] = [len(t) for t in tokenizers.gpt2_tokenizer(examples["content"], return_attention_mask=False)["input_ids"]]
     
     examples["gpt4_length"] = [len(t) for t in tokenizers.gpt4_tokenizer.encode_batch(examples["content"], disallowed_special=())]
     
-    examples["llama_length"] = [len(t) for t in tokenizers.llama_tokenizer(examples["content"])["input_ids"]]
+    examples["llama_length"] = [len(t) for t in tokenizers.llama_tokenizer(examples["content"], return_attention_mask=False)["input_ids"]]
     
-    examples["falcon_length"] = [len(t) for t in tokenizers.falcon_tokenizer(examples["content"])["input_ids"]]
+    examples["falcon_length"] = [len(t) for t in tokenizers.falcon_tokenizer(examples["content"], return_attention_mask=False)["input_ids"]]
     return examples
 
 
@@ -1,26 +1,43 @@
 from transformers import AutoTokenizer
 import argparse
+import os
+import sys
 import tiktoken
 
+HF_TOKENIZER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "3-hf-tokenizer")
+TOKENIZERS = ("gpt2", "gpt2-stream", "gpt4", "llama", "falcon")
+
 parser = argparse.ArgumentParser()
 parser.add_argument("--file_path" , type=str, default="all_pg_essays.txt")
+# gpt2-stream: MySlowTokenizer from chapter 3 (same ids as GPT2's tokenizer) reads the file in chunks, so memory stays
+# flat however big the file is. It's much slower than the Rust tokenizer, so only use it for files that don't fit in memory
+parser.add_argument("--tokenizers", type=str, nargs="+", default=["gpt2", "gpt4", "llama", "falcon"], choices=TOKENIZERS)
 
-if __name__ == "__main__":
-    gpt2_tokenizer = AutoTokenizer.from_pretrained("gpt2")
-    gpt4_tokenizer = tiktoken.encoding_for_model("gpt-4")
-    llama_tokenizer = AutoTokenizer.from_pretrained("meta-llama/Llama-2-13b-hf")
-    falcon_tokenizer = AutoTokenizer.from_pretrained("tiiuae/falcon-40b")
+def count_gpt2_stream(file_path: str) -> int:
+    sys.path.insert(0, HF_TOKENIZER_DIR)
+    from minimal_hf_tok import MySlowTokenizer
+    tokenizer = MySlowTokenizer(os.path.join(HF_TOKENIZER_DIR, "vocab.json"))
+    with open(file_path, "r") as f:
+        return sum(len(ids) for ids in tokenizer.encode_stream(f))
 
+if __name__ == "__main__":
     args = parser.parse_args()
     file_path = args.file_path
-    with open(file_path, "r") as f:
-        data = f.read()
-    
-    gpt2_tokens = len(gpt2_tokenizer.encode(data))
-    gpt4_tokens = len(gpt4_tokenizer.encode(data))
-    llama_tokens = len(llama_tokenizer.encode(data))
-    falcon_tokens = len(falcon_tokenizer.encode(data))
-    print(f"Number of tokens for GPT2: {gpt2_tokens}")
-    print(f"Number of tokens for GPT4: {gpt4_tokens}")
-    print(f"Number of tokens for Llama: {llama_tokens}")
-    print(f"Number of tokens for Falcon: {falcon_tokens}")
+    counts = {}
+    if "gpt2-stream" in args.tokenizers:
+        counts["gpt2-stream"] = count_gpt2_stream(file_path)
+    tokenizers = {
+        "gpt2": lambda: AutoTokenizer.from_pretrained("gpt2"),
+        "gpt4": lambda: tiktoken.encoding_for_model("gpt-4"),
+        "llama": lambda: AutoTokenizer.from_pretrained("meta-llama/Llama-2-13b-hf"),
+        "falcon": lambda: AutoTokenizer.from_pretrained("tiiuae/falcon-40b"),
+    }
+    names = [name for name in args.tokenizers if name in tokenizers]
+    if names:
+        # the other tokenizers need the whole text at once
+        with open(file_path, "r") as f:
+            data = f.read()
+        for name in names:
+            counts[name] = len(tokenizers[name]().encode(data))
+    for name in args.tokenizers:
+        print(f"Number of tokens for {name.upper() if name.startswith('gpt') else name.capitalize()}: {counts[name]}")
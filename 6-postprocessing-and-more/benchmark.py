@@ -1,27 +1,295 @@
-from datasets import load_dataset 
-from transformers import AutoTokenizer 
-import time 
-from functools import partial 
-tiny_tokenizer = AutoTokenizer.from_pretrained(".")
-mname = "microsoft/deberta-base"
-tokenizer = AutoTokenizer.from_pretrained(mname, use_fast=True)
+"""
+Offline tokenizer benchmark. Runs tokenizers on bundled/synthetic corpora and saves the results to JSON, and compares
+results against a saved baseline to catch regressions. No network needed.
 
-dataset = load_dataset("imdb")["train"]
+Tokenizers (`--tokenizers`):
+    bpe                  `BPE.encode_bytes` alone, on words pre-tokenized outside of the timed region
+    slow                 `MySlowTokenizer` with the default options
+    slow-nocache         `MySlowTokenizer` without the word cache
+    slow-heap            `MySlowTokenizer` with the heap merge engine
+    slow:PATH            `MySlowTokenizer` loaded from another vocab file (ex: a shrunk or compiled tokenizer)
+    hf:PATH              a local 🤗 tokenizer directory, ex: the output of `tokenizer_shrink.py` (needs `transformers`)
+Corpora: prose, code (Python-like functions), cjk, whitespace (heavily indented code and blank lines) and long_words
+(minified JSON, base64-like blobs, long identifiers). All of them are generated from `--seed`, so they don't change
+with the files of the repo. Results store a hash of the corpora, and `compare` refuses results on different corpora.
 
-def get_example(ex, tokenizer):
-    inps = tokenizer(ex["text"])
-    return inps
+Each tokenizer runs in a fresh process, so that startup time and peak RSS are its own.
+Usage:
+    python benchmark.py run --output results.json
+    python benchmark.py compare baseline.json results.json --threshold 0.1
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import resource
+import string
+import subprocess
+import sys
+import time
+from typing import Dict, List
 
-start_time = time.time()
-func = partial(get_example, tokenizer=tokenizer)
-mapped = dataset.map(func, batched=True, load_from_cache_file=False)
-end_time = time.time()
-print("time: ", end_time - start_time)
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HF_TOKENIZER_DIR = os.path.join(REPO_DIR, "3-hf-tokenizer")
+DEFAULT_VOCAB_FILE = os.path.join(HF_TOKENIZER_DIR, "vocab.json")
+CORPORA = ("prose", "code", "cjk", "whitespace", "long_words")
+DEFAULT_TOKENIZERS = ("bpe", "slow", "slow-nocache", "slow-heap")
+# metric -> True if higher is better. Used by `compare`
+METRICS = {
+    "bytes_per_s": True,
+    "tokens_per_s": True,
+    "p50_ms": False,
+    "p99_ms": False,
+    "peak_rss_mb": False,
+    "startup_s": False,
+}
 
 
+# Words for the generated prose and code corpora
+PROSE_WORDS = (
+    "the a of to and in is that it for with as was on be by this are from or have an they which one you were her all "
+    "she there would their we him been has when who will more no if out so said what up its about into than them can "
+    "only other new some could time these two may then do first any my now such like our over man me even most made "
+    "after also did many before must through back years where much your way well down should because each just those "
+    "people how too little state good very make world still own see men work long get here between both life being "
+    "under never day same another know while last might us great old year off come since against go came right used "
+    "tokenizer tokenizers vocabulary merges subword encoding decoding training corpus byte pair model embedding"
+).split()
+CODE_WORDS = ("token", "tokens", "ids", "text", "vocab", "merges", "word", "words", "pair", "pairs", "cache", "size", "index", "offset", "batch", "result", "count", "pattern")
 
-start_time = time.time()
-func = partial(get_example, tokenizer=tiny_tokenizer)
-mapped = dataset.map(func, batched=True, load_from_cache_file=False)
-end_time = time.time()
-print("time: ", end_time - start_time)
\ No newline at end of file
+
+def make_prose(rng: random.Random) -> str:
+    # paragraphs of sentences with capitals, numbers, quotes and contractions
+    paragraphs = []
+    for _ in range(rng.randint(1, 4)):
+        sentences = []
+        for _ in range(rng.randint(2, 8)):
+            words = [rng.choice(PROSE_WORDS) for _ in range(rng.randint(4, 25))]
+            if rng.random() < 0.2:
+                words.insert(rng.randrange(len(words)), str(rng.randint(0, 10**rng.randint(1, 6))))
+            if rng.random() < 0.2:
+                words.insert(rng.randrange(len(words)), rng.choice(["don't", "it's", "we'll", "they're", "I'm", "you've"]))
+            if rng.random() < 0.1:
+                words[-1] = f'"{words[-1]}"'
+            sentences.append(" ".join(words).capitalize() + rng.choice([".", ".", ".", "?", "!", ":"]))
+        paragraphs.append(" ".join(sentences))
+    return "\n\n".join(paragraphs)
+
+
+def make_code(rng: random.Random) -> str:
+    # a Python function with a docstring, arguments, loops, calls and comments
+    def name():
+        return "_".join(rng.choice(CODE_WORDS) for _ in range(rng.randint(1, 3)))
+    arguments = [name() for _ in range(rng.randint(0, 4))]
+    annotations = [rng.choice(["int", "str", "List[int]", "Dict[str, int]"]) for _ in arguments]
+    lines = [f"def {name()}({', '.join(f'{arg}: {annotation}' for arg, annotation in zip(arguments, annotations))}):"]
+    lines.append(f'    """\n    {" ".join(rng.choice(PROSE_WORDS) for _ in range(rng.randint(3, 15))).capitalize()}.\n    """')
+    depth = 1
+    for _ in range(rng.randint(3, 20)):
+        indent = "    " * depth
+        kind = rng.randrange(5)
+        if kind == 0 and depth < 4:
+            lines.append(f"{indent}for {name()} in range(len({name()})):")
+            depth += 1
+            continue
+        if kind == 1 and depth < 4:
+            operator = rng.choice(["==", "<", ">=", "in", "is not"])
+            lines.append(f"{indent}if {name()} {operator} {rng.choice([name(), str(rng.randint(0, 1000)), 'None'])}:")
+            depth += 1
+            continue
+        if kind == 2:
+            lines.append(f"{indent}# {' '.join(rng.choice(PROSE_WORDS) for _ in range(rng.randint(2, 10)))}")
+        else:
+            lines.append(f"{indent}{name()} = {name()}.{name()}({', '.join(name() for _ in range(rng.randint(0, 3)))})")
+        if depth > 1 and kind != 2 and rng.random() < 0.3:
+            depth -= 1
+    lines.append(f"    return {name()}")
+    return "\n".join(lines)
+
+
+def make_corpus(name: str, num_docs: int, seed: int) -> List[str]:
+    """
+    Deterministic list of documents for a corpus, generated from `seed`.
+    """
+    rng = random.Random(f"{name}-{seed}")
+    if name == "prose":
+        return [make_prose(rng) for _ in range(num_docs)]
+    if name == "code":
+        return [make_code(rng) for _ in range(num_docs)]
+    if name == "whitespace":
+        # re-indent code with big runs of tabs/spaces and add blank lines
+        return ["\n".join(rng.choice(["\t\t", " " * 12, "    \t"]) * rng.randint(1, 4) + line + "\n" * rng.randint(0, 3) for line in make_code(rng).splitlines()) for _ in range(num_docs)]
+    if name == "cjk":
+        chars = [chr(c) for c in range(0x4E00, 0x4E00 + 3000)] + [chr(c) for c in range(0x3041, 0x3097)] + list("、。「」！？")
+        return ["".join(rng.choice(chars) for _ in range(rng.randint(50, 500))) for _ in range(num_docs)]
+    if name == "long_words":
+        def blob():
+            kind = rng.randrange(3)
+            if kind == 0:
+                return json.dumps({f"k{i}": [rng.randint(0, 999), "v" * rng.randint(1, 5)] for i in range(rng.randint(20, 100))}, separators=(",", ":"))
+            if kind == 1:
+                return "".join(rng.choice(string.ascii_letters + string.digits + "+/") for _ in range(rng.randint(500, 3000)))
+            return "_".join(rng.choice(["get", "user", "account", "manager", "factory", "impl", "v2"]) for _ in range(rng.randint(20, 80)))
+        return [blob() for _ in range(num_docs)]
+    raise ValueError(f"Unknown corpus {name}, should be one of {CORPORA}")
+
+
+def corpus_hash(num_docs: int, seed: int) -> str:
+    """
+    sha256 of all the corpora, to check that two results were measured on the same inputs.
+    """
+    digest = hashlib.sha256()
+    for corpus in CORPORA:
+        for doc in make_corpus(corpus, num_docs, seed):
+            digest.update(doc.encode("utf-8", "surrogatepass"))
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def load_tokenizer(spec: str):
+    """
+    Returns an `encode(text) -> ids` function and a `prepare(docs) -> inputs` function for a tokenizer spec.
+    """
+    sys.path.insert(0, HF_TOKENIZER_DIR)
+    from minimal_hf_tok import MySlowTokenizer
+    if spec == "bpe":
+        tokenizer = MySlowTokenizer(DEFAULT_VOCAB_FILE, cache_size=0)
+        bpe = tokenizer.bpe
+        def encode(words):
+            return [token_id for word in words for token_id in bpe.encode_bytes(word)]
+        def prepare(docs):
+            return [[word.encode("utf-8") for word in tokenizer.pre_tokenize(doc)] for doc in docs]
+        return encode, prepare
+    if spec.startswith("hf:"):
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(spec[len("hf:"):], local_files_only=True)
+        return (lambda doc: tokenizer.encode(doc, add_special_tokens=False)), (lambda docs: docs)
+    if spec.startswith("slow:"):
+        tokenizer = MySlowTokenizer(spec[len("slow:"):])
+    elif spec in ("slow", "slow-nocache", "slow-heap"):
+        options = {"slow": {}, "slow-nocache": {"cache_size": 0}, "slow-heap": {"merge_engine": "heap"}}[spec]
+        tokenizer = MySlowTokenizer(DEFAULT_VOCAB_FILE, **options)
+    else:
+        raise ValueError(f"Unknown tokenizer {spec}")
+    return tokenizer.encode, (lambda docs: docs)
+
+
+def percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run_tokenizer(spec: str, num_docs: int, seed: int, repeats: int) -> List[Dict]:
+    """
+    Benchmarks one tokenizer on all corpora. Meant to run in its own process.
+    """
+    start = time.perf_counter()
+    encode, prepare = load_tokenizer(spec)
+    startup_s = time.perf_counter() - start
+    results = []
+    for corpus in CORPORA:
+        docs = make_corpus(corpus, num_docs, seed)
+        inputs = prepare(docs)
+        num_bytes = sum(len(doc.encode("utf-8")) for doc in docs)
+        best_total, latencies, num_tokens = float("inf"), [], 0
+        for _ in range(repeats):
+            run_latencies = []
+            num_tokens = 0
+            for item in inputs:
+                doc_start = time.perf_counter()
+                num_tokens += len(encode(item))
+                run_latencies.append(time.perf_counter() - doc_start)
+            latencies.extend(run_latencies)
+            best_total = min(best_total, sum(run_latencies))
+        results.append({
+            "tokenizer": spec,
+            "corpus": corpus,
+            "num_docs": len(docs),
+            "num_bytes": num_bytes,
+            "num_tokens": num_tokens,
+            "bytes_per_s": num_bytes / best_total,
+            "tokens_per_s": num_tokens / best_total,
+            "p50_ms": percentile(latencies, 0.5) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, # KB on Linux
+            "startup_s": startup_s,
+        })
+    return results
+
+
+def run(args):
+    results = []
+    for spec in args.tokenizers:
+        command = [sys.executable, os.path.abspath(__file__), "_worker", spec, "--docs", str(args.docs), "--seed", str(args.seed), "--repeats", str(args.repeats)]
+        output = subprocess.run(command, capture_output=True, text=True)
+        if output.returncode != 0:
+            raise RuntimeError(f"Benchmark for {spec} failed:\n{output.stderr}")
+        results.extend(json.loads(output.stdout.splitlines()[-1]))
+    report = {
+        "meta": {"python": platform.python_version(), "platform": platform.platform(), "docs": args.docs, "seed": args.seed, "repeats": args.repeats, "corpus_hash": corpus_hash(args.docs, args.seed)},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"{'tokenizer':>16} {'corpus':>11} {'MB/s':>7} {'ktok/s':>8} {'p50 ms':>8} {'p99 ms':>8} {'RSS MB':>7} {'startup s':>9}")
+    for r in results:
+        print(f"{r['tokenizer']:>16} {r['corpus']:>11} {r['bytes_per_s'] / 1e6:7.2f} {r['tokens_per_s'] / 1e3:8.1f} {r['p50_ms']:8.3f} {r['p99_ms']:8.3f} {r['peak_rss_mb']:7.1f} {r['startup_s']:9.3f}")
+    print(f"Saved results to {args.output}")
+
+
+def compare(args) -> int:
+    """
+    Prints metrics that got worse by more than `threshold` (relative) and returns the number of regressions.
+    Raises a `ValueError` if the two results weren't measured on the same corpora.
+    """
+    with open(args.baseline) as f:
+        baseline_report = json.load(f)
+    with open(args.results) as f:
+        report = json.load(f)
+    baseline_hash, results_hash = baseline_report["meta"].get("corpus_hash"), report["meta"].get("corpus_hash")
+    if baseline_hash is None or baseline_hash != results_hash:
+        raise ValueError(f"{args.baseline} and {args.results} were not run on the same corpora (corpus hash {baseline_hash} vs {results_hash}), re-run the baseline")
+    baseline = {(r["tokenizer"], r["corpus"]): r for r in baseline_report["results"]}
+    results = report["results"]
+    regressions = 0
+    for r in results:
+        old = baseline.get((r["tokenizer"], r["corpus"]))
+        if old is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if not old[metric]:
+                continue
+            change = (r[metric] - old[metric]) / old[metric]
+            if (change < -args.threshold) if higher_is_better else (change > args.threshold):
+                regressions += 1
+                print(f"REGRESSION {r['tokenizer']}/{r['corpus']} {metric}: {old[metric]:.4g} -> {r[metric]:.4g} ({change:+.1%})")
+    print(f"{regressions} regression(s) with threshold {args.threshold:.0%}")
+    return regressions
+
+
+parser = argparse.ArgumentParser()
+subparsers = parser.add_subparsers(dest="command", required=True)
+run_parser = subparsers.add_parser("run", help="Run the benchmark and save results")
+run_parser.add_argument("--tokenizers", type=str, nargs="+", default=list(DEFAULT_TOKENIZERS))
+run_parser.add_argument("--output", type=str, default="benchmark_results.json")
+compare_parser = subparsers.add_parser("compare", help="Compare results against a baseline")
+compare_parser.add_argument("baseline", type=str)
+compare_parser.add_argument("results", type=str)
+compare_parser.add_argument("--threshold", type=float, default=0.1, help="Relative change that counts as a regression")
+worker_parser = subparsers.add_parser("_worker") # internal: benchmark one tokenizer and print JSON
+worker_parser.add_argument("tokenizer", type=str)
+for subparser in (run_parser, worker_parser):
+    subparser.add_argument("--docs", type=int, default=200, help="Documents per corpus")
+    subparser.add_argument("--seed", type=int, default=0)
+    subparser.add_argument("--repeats", type=int, default=3)
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    elif args.command == "compare":
+        sys.exit(1 if compare(args) else 0)
+    else:
+        print(json.dumps(run_tokenizer(args.tokenizer, args.docs, args.seed, args.repeats)))
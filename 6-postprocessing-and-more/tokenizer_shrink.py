@@ -1,48 +1,229 @@
 """
-Tokenizer shrinking recipe from Stas Bekman and Anthony Moi.
-Reference: https://discuss.huggingface.co/t/tokenizer-shrinking-recipes/8564 
-For more details, please see: https://github.com/stas00/ml-engineering/  
-"""
+Frequency-driven tokenizer shrinking, for tiny debug models.
+Based on the tokenizer shrinking recipe from Stas Bekman and Anthony Moi.
+Reference: https://discuss.huggingface.co/t/tokenizer-shrinking-recipes/8564
+For more details, please see: https://github.com/stas00/ml-engineering/
+
+The original recipe keeps the first N ids, which are not the tokens a corpus actually uses. Here, a sample corpus is
+run through the tokenizer to count token usage, and we keep:
+- the `--top_k` most used tokens
+- for BPE, every token needed to build them through merges (the "merge closure"), so that they can still be produced
+- the base alphabet (tokens that no merge produces, ex: the 256 byte tokens of GPT2) and the added/special tokens
+Kept tokens are re-packed densely, in their original order, and merges are kept if both parts and the result are kept.
+Besides the shrunk tokenizer, the tool writes the id remap table (`remap.json`) and reports how sequence length, encode
+time and the time to load an embedding matrix change compared with the original.
 
+Usage:
+    # our own vocab.json (HF's BPE model format) with `MySlowTokenizer` from chapter 3
+    python tokenizer_shrink.py --vocab_file ../3-hf-tokenizer/vocab.json --top_k 2000 --output_dir gpt2_tiny
+    # a fast 🤗 tokenizer (needs `transformers`)
+    python tokenizer_shrink.py --hf_tokenizer microsoft/deberta-base --top_k 5000 --output_dir deberta-base_tiny
+"""
+import argparse
+import glob
 import json
-from transformers import AutoTokenizer
-from tokenizers import Tokenizer
-
-vocab_keep_items = 5000
-mname = "microsoft/deberta-base"
-
-
-tokenizer = AutoTokenizer.from_pretrained(mname, use_fast=True)
-assert tokenizer.is_fast, "This only works for fast tokenizers."
-tokenizer_json = json.loads(tokenizer._tokenizer.to_str())
-vocab = tokenizer_json["model"]["vocab"]
-# Iterate over the vocabulary for different models and keep only the first `vocab_keep_items` tokens
-if tokenizer_json["model"]["type"] == "BPE":
-    new_vocab = { token: i for token, i in vocab.items() if i < vocab_keep_items }
-    merges = tokenizer_json["model"]["merges"]
-    new_merges = []
-    # handle merges: keep only the merge rules for which the (merging) pair of tokens and the merged token are in the new vocab
-    for i in range(len(merges)):
-        a, b = merges[i].split()
-        new_token = "".join((a, b))
-        if a in new_vocab and b in new_vocab and new_token in new_vocab:
-            new_merges.append(merges[i])
-    tokenizer_json["model"]["merges"] = new_merges
-elif tokenizer_json["model"]["type"] == "Unigram":
-    new_vocab = vocab[:vocab_keep_items]
-elif tokenizer_json["model"]["type"] == "WordPiece" or tokenizer_json["model"]["type"] == "WordLevel":
-    new_vocab = { token: i for token, i in vocab.items() if i < vocab_keep_items }
-else:
-    raise ValueError(f"don't know how to handle {tokenizer_json['model']['type']}")
-
-# a hack for GPT2, since a special token is at the END of the vocab - most tokenizers have it at the beginning
-if "gpt2" in mname:
-        new_vocab = { token: i for token, i in vocab.items() if i < vocab_keep_items-1 }
-        new_vocab["<|endoftext|>"] = vocab_keep_items-1
-else:
-    new_vocab = { token: i for token, i in vocab.items() if i < vocab_keep_items }
-
-tokenizer_json["model"]["vocab"] = new_vocab
-tokenizer._tokenizer = Tokenizer.from_str(json.dumps(tokenizer_json))
-save_name = mname.split("/")[-1] + "_tiny"
-tokenizer.save_pretrained(save_name)
\ No newline at end of file
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Callable, Dict, List, Tuple
+import numpy as np
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+HF_TOKENIZER_DIR = os.path.join(REPO_DIR, "3-hf-tokenizer")
+
+
+def read_corpus(patterns: List[str]) -> List[str]:
+    """
+    Paragraphs of all files matching `patterns`, as documents.
+    """
+    docs = []
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, "r", encoding="utf-8") as f:
+                docs.extend(paragraph for paragraph in f.read().split("\n\n") if paragraph.strip())
+    if not docs:
+        raise ValueError(f"No documents found in {patterns}")
+    return docs
+
+
+def count_token_usage(encode: Callable[[str], List[int]], docs: List[str]) -> Counter:
+    counts = Counter()
+    for doc in docs:
+        counts.update(encode(doc))
+    return counts
+
+
+def select_tokens(model: dict, counts: Counter, top_k: int, always_keep: List[int]) -> List[int]:
+    """
+    Ids to keep, in their original order. See the module docstring.
+    """
+    if model["type"] == "Unigram":
+        vocab = {entry[0]: index for index, entry in enumerate(model["vocab"])}
+    else:
+        vocab = model["vocab"]
+    id_to_token = {index: token for token, index in vocab.items()}
+    kept = set(always_keep)
+    kept.update(index for index, _ in counts.most_common(top_k))
+    if model["type"] == "BPE":
+        producer = {} # token -> (left, right) of the first merge that produces it
+        for merge in model["merges"]:
+            left, right = merge.split(" ") if isinstance(merge, str) else merge
+            producer.setdefault(left + right, (left, right))
+        # the alphabet: no merge produces these, so everything else is built from them
+        kept.update(index for token, index in vocab.items() if token not in producer)
+        stack = [id_to_token[index] for index in kept if index in id_to_token]
+        while stack:
+            token = stack.pop()
+            for part in producer.get(token, ()):
+                if vocab[part] not in kept:
+                    kept.add(vocab[part])
+                    stack.append(part)
+    elif model.get("unk_token") is not None and model["unk_token"] in vocab:
+        kept.add(vocab[model["unk_token"]])
+    elif model["type"] == "Unigram" and model.get("unk_id") is not None:
+        kept.add(model["unk_id"])
+    return sorted(kept)
+
+
+def shrink_model(model: dict, kept: List[int]) -> Tuple[dict, Dict[int, int]]:
+    """
+    Returns the shrunk model (same format as `model`) and the old id -> new id table.
+    """
+    remap = {old: new for new, old in enumerate(kept)}
+    model = dict(model)
+    if model["type"] == "Unigram":
+        model["vocab"] = [model["vocab"][old] for old in kept]
+        if model.get("unk_id") is not None:
+            model["unk_id"] = remap[model["unk_id"]]
+        return model, remap
+    new_vocab = {token: remap[index] for token, index in model["vocab"].items() if index in remap}
+    if model["type"] == "BPE":
+        new_merges = []
+        for merge in model["merges"]:
+            left, right = merge.split(" ") if isinstance(merge, str) else merge
+            # keep only the merge rules for which the pair of tokens and the merged token are in the new vocab
+            if left in new_vocab and right in new_vocab and left + right in new_vocab:
+                new_merges.append(merge)
+        model["merges"] = new_merges
+    model["vocab"] = new_vocab
+    return model, remap
+
+
+def remap_special_ids(obj, remap: Dict[int, int]):
+    """
+    Updates token ids stored in a 🤗 `tokenizer.json` post-processor, in place: ("[SEP]", 102) pairs of
+    Bert/RobertaProcessing and the "ids" lists of TemplateProcessing.
+    """
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            if key in ("sep", "cls") and isinstance(value, list) and len(value) == 2:
+                obj[key] = [value[0], remap[value[1]]]
+            elif key == "ids" and isinstance(value, list):
+                obj[key] = [remap[index] for index in value]
+            else:
+                remap_special_ids(value, remap)
+    elif isinstance(obj, list):
+        for value in obj:
+            remap_special_ids(value, remap)
+
+
+def embedding_load_time(vocab_size: int, hidden_size: int, repeats: int = 3) -> Tuple[float, float]:
+    """
+    Size (MB) and time (s) to load a float32 (vocab_size, hidden_size) embedding matrix from disk.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "embeddings.npy")
+        np.save(path, np.random.default_rng(0).standard_normal((vocab_size, hidden_size), dtype=np.float32))
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            np.load(path)
+            times.append(time.perf_counter() - start)
+        return os.path.getsize(path) / 1e6, min(times)
+
+
+def time_encode(encode: Callable[[str], List[int]], docs: List[str]) -> Tuple[int, float]:
+    start = time.perf_counter()
+    num_tokens = sum(len(encode(doc)) for doc in docs)
+    return num_tokens, time.perf_counter() - start
+
+
+def report(docs: List[str], encoders: Dict[str, Callable[[str], List[int]]], vocab_sizes: Dict[str, int], hidden_size: int):
+    print(f"Evaluated on {len(docs)} documents")
+    print(f"{'tokenizer':>10} {'vocab':>7} {'tokens/doc':>10} {'encode (s)':>10} {'embeddings (MB)':>15} {'load (ms)':>9}")
+    rows = {}
+    for name, encode in encoders.items():
+        num_tokens, encode_time = time_encode(encode, docs)
+        size_mb, load_time = embedding_load_time(vocab_sizes[name], hidden_size)
+        rows[name] = num_tokens
+        print(f"{name:>10} {vocab_sizes[name]:7d} {num_tokens / len(docs):10.1f} {encode_time:10.3f} {size_mb:15.1f} {load_time * 1000:9.1f}")
+    original, shrunk = rows["original"], rows["shrunk"]
+    print(f"Sequence length change: {(shrunk - original) / original:+.1%}")
+
+
+def shrink_vocab_file(args, docs: List[str]):
+    sys.path.insert(0, HF_TOKENIZER_DIR)
+    from minimal_hf_tok import MySlowTokenizer
+    with open(args.vocab_file, "r") as f:
+        model = json.load(f)
+    tokenizer = MySlowTokenizer(args.vocab_file)
+    counts = count_token_usage(tokenizer.encode, docs)
+    tokenizer.cache.clear() # so that both tokenizers start cold in the report
+    kept = select_tokens(model, counts, args.top_k, [tokenizer.convert_token_to_id(token) for token in tokenizer.added_tokens_trie._tokens])
+    new_model, remap = shrink_model(model, kept)
+    os.makedirs(args.output_dir, exist_ok=True)
+    new_vocab_file = os.path.join(args.output_dir, "vocab.json")
+    with open(new_vocab_file, "w") as f:
+        json.dump(new_model, f, ensure_ascii=False)
+    shrunk = MySlowTokenizer(new_vocab_file)
+    return remap, {"original": tokenizer.encode, "shrunk": shrunk.encode}, {"original": len(model["vocab"]), "shrunk": len(new_model["vocab"])}
+
+
+def shrink_hf_tokenizer(args, docs: List[str]):
+    from transformers import AutoTokenizer
+    from tokenizers import Tokenizer
+    tokenizer = AutoTokenizer.from_pretrained(args.hf_tokenizer, use_fast=True)
+    assert tokenizer.is_fast, "This only works for fast tokenizers."
+    tokenizer_json = json.loads(tokenizer._tokenizer.to_str())
+    model = tokenizer_json["model"]
+    if model["type"] not in ("BPE", "Unigram", "WordPiece", "WordLevel"):
+        raise ValueError(f"don't know how to handle {model['type']}")
+    encode = lambda doc: tokenizer.encode(doc, add_special_tokens=False)
+    counts = count_token_usage(encode, docs)
+    kept = select_tokens(model, counts, args.top_k, [token["id"] for token in tokenizer_json["added_tokens"]])
+    new_model, remap = shrink_model(model, kept)
+    tokenizer_json["model"] = new_model
+    for token in tokenizer_json["added_tokens"]:
+        token["id"] = remap[token["id"]]
+    remap_special_ids(tokenizer_json.get("post_processor"), remap)
+    original_vocab_size = len(tokenizer)
+    original_encode = lambda doc, backend=tokenizer._tokenizer: backend.encode(doc, add_special_tokens=False).ids
+    tokenizer._tokenizer = Tokenizer.from_str(json.dumps(tokenizer_json))
+    tokenizer.save_pretrained(args.output_dir)
+    shrunk = AutoTokenizer.from_pretrained(args.output_dir)
+    return remap, {"original": original_encode, "shrunk": lambda doc: shrunk.encode(doc, add_special_tokens=False)}, {"original": original_vocab_size, "shrunk": len(shrunk)}
+
+
+parser = argparse.ArgumentParser()
+source = parser.add_mutually_exclusive_group(required=True)
+source.add_argument("--vocab_file", type=str, help="A vocab.json in HF's BPE model format, like chapter 3's")
+source.add_argument("--hf_tokenizer", type=str, help="Name or path of a fast 🤗 tokenizer")
+parser.add_argument("--top_k", type=int, default=5000, help="Number of most used tokens to keep (before adding the alphabet and merge closure)")
+parser.add_argument("--corpus", type=str, nargs="+", default=[os.path.join(REPO_DIR, "*", "README.md")], help="Files (or glob patterns) used to count token usage")
+parser.add_argument("--eval_corpus", type=str, nargs="+", default=None, help="Files used for the report. Defaults to --corpus")
+parser.add_argument("--output_dir", type=str, required=True)
+parser.add_argument("--hidden_size", type=int, default=768, help="Embedding dimension for the embedding-load timing")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    docs = read_corpus(args.corpus)
+    eval_docs = read_corpus(args.eval_corpus) if args.eval_corpus else docs
+    shrink = shrink_vocab_file if args.vocab_file else shrink_hf_tokenizer
+    remap, encoders, vocab_sizes = shrink(args, docs)
+    with open(os.path.join(args.output_dir, "remap.json"), "w") as f:
+        # new id -> old id as a list, and old id -> new id, ex: to slice an embedding matrix with `weights[new_to_old]`
+        json.dump({"new_to_old": list(remap), "old_to_new": {str(old): new for old, new in remap.items()}}, f)
+    print(f"Kept {vocab_sizes['shrunk']} of {vocab_sizes['original']} tokens, saved to {args.output_dir}")
+    report(eval_docs, encoders, vocab_sizes, args.hidden_size)
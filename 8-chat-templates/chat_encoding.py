@@ -0,0 +1,231 @@
+"""
+Prefix-cached chat encoding with assistant-only label masks, on top of `MySlowTokenizer` from chapter 3.
+
+Formatting a conversation message by message is what you need to build `labels`, but re-tokenizing the whole
+conversation for every new turn means encoding the same system prompt and earlier turns over and over again.
+`ChatEncoder` renders each message with a template and encodes the conversation like a stream: after each message,
+the ids are emitted up to the last safe boundary (the same rule as `MySlowTokenizer.encode_stream`), and the state at
+that point is cached under a hash of all messages so far. A conversation that shares a prefix with an earlier one
+(same system prompt, same earlier turns) picks up from the cache and only encodes the new messages.
+
+The ids are always exactly `tokenizer.encode(encoder.render(messages))`. The mask marks the tokens that overlap the
+trained segments of the template (assistant content and its end-of-turn marker), computed in the same pass.
+Usage:
+    python chat_encoding.py --template chatml --num_conversations 200
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import os
+import random
+import sys
+import time
+from typing import Dict, List, Tuple
+
+HF_TOKENIZER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "3-hf-tokenizer")
+sys.path.insert(0, HF_TOKENIZER_DIR)
+from minimal_hf_tok import LRUCache, MySlowTokenizer
+
+IGNORE_INDEX = -100 # label for tokens that don't count in the loss
+
+
+def chatml(message: Dict[str, str]) -> List[Tuple[str, bool]]:
+    """
+    ChatML: <|im_start|>role\\ncontent<|im_end|>\\n. Returns (text, trained) segments.
+    """
+    trained = message["role"] == "assistant"
+    return [(f"<|im_start|>{message['role']}\n", False), (message["content"] + "<|im_end|>", trained), ("\n", False)]
+
+
+def inst(message: Dict[str, str]) -> List[Tuple[str, bool]]:
+    """
+    Mistral-style: [INST] user [/INST]assistant</s>. The markers are plain text here, not added tokens.
+    """
+    if message["role"] == "assistant":
+        return [(message["content"] + "</s>", True)]
+    return [(f"[INST] {message['content']} [/INST]", False)]
+
+
+# template name -> (render function, added tokens the template needs)
+TEMPLATES = {
+    "chatml": (chatml, ["<|im_start|>", "<|im_end|>"]),
+    "inst": (inst, []),
+}
+
+
+class ChatEncoder:
+    """
+    Encodes conversations (lists of {"role": ..., "content": ...}) into ids and an assistant-only mask, reusing the
+    work done for shared prefixes. Added tokens the template needs are added to the tokenizer (quietly) if it doesn't
+    have them yet, so building several encoders on one tokenizer only changes it once.
+    """
+    def __init__(self, tokenizer: MySlowTokenizer, template: str = "chatml", cache_size: int = 2**12):
+        if template not in TEMPLATES:
+            raise ValueError(f"template should be one of {list(TEMPLATES)}, got {template}")
+        self.tokenizer = tokenizer
+        self.template = template
+        self.render_message, special_tokens = TEMPLATES[template]
+        missing = [token for token in special_tokens if token not in tokenizer.added_tokens_trie._tokens]
+        if missing:
+            with contextlib.redirect_stdout(io.StringIO()): # `add_tokens` prints every token
+                tokenizer.add_tokens(missing)
+        # prefix hash -> state after that prefix, see `encode`. Cleared if tokens are added to the tokenizer
+        self.cache = LRUCache(cache_size)
+        self._num_added_tokens = len(tokenizer.added_tokens)
+
+    def render(self, messages: List[Dict[str, str]]) -> str:
+        return "".join(text for message in messages for text, _ in self.render_message(message))
+
+    def encode(self, messages: List[Dict[str, str]]) -> Tuple[List[int], List[int]]:
+        """
+        Returns (input_ids, assistant_mask) with 1 in the mask for tokens to train on.
+        """
+        tokenizer = self.tokenizer
+        if len(tokenizer.added_tokens) != self._num_added_tokens:
+            self.cache.clear() # cached ids were computed with another vocabulary
+            self._num_added_tokens = len(tokenizer.added_tokens)
+        margin = max((len(token) for token in tokenizer.added_tokens_trie._tokens), default=0)
+        input_ids, mask = [], []
+        # text that isn't encoded yet, and the trained byte ranges in it
+        pending, spans = "", []
+        digest = hashlib.sha256(self.template.encode("utf-8"))
+        resumed = True
+        for message in messages:
+            segments = self.render_message(message)
+            digest.update(json.dumps(segments).encode("utf-8"))
+            key = digest.digest()
+            if resumed:
+                state = self.cache.get(key)
+                if state is not None:
+                    # each cache entry holds the ids emitted for its own message, so the prefix is rebuilt by replaying them
+                    ids_delta, mask_delta, pending, spans = state
+                    input_ids.extend(ids_delta)
+                    mask.extend(mask_delta)
+                    spans = list(spans)
+                    continue
+                resumed = False
+            num_bytes = len(pending.encode("utf-8"))
+            for text, trained in segments:
+                text_bytes = len(text.encode("utf-8"))
+                if trained and text_bytes:
+                    spans.append((num_bytes, num_bytes + text_bytes))
+                pending += text
+                num_bytes += text_bytes
+            # emit everything before the last safe cut, keep the rest for the next message
+            pieces = tokenizer._split_with_offsets(pending)
+            last = tokenizer._last_safe_cut(pending, pieces, margin)
+            start = len(input_ids)
+            cut_bytes = self._emit(pieces[:last], spans, input_ids, mask)
+            if last > 0:
+                pending = pending[pieces[last][0]:]
+                spans = [(max(0, begin - cut_bytes), end - cut_bytes) for begin, end in spans if end > cut_bytes]
+            self.cache.put(key, (tuple(input_ids[start:]), tuple(mask[start:]), pending, tuple(spans)))
+        self._emit(tokenizer._split_with_offsets(pending), spans, input_ids, mask)
+        return input_ids, mask
+
+    def _emit(self, pieces, spans: List[Tuple[int, int]], input_ids: List[int], mask: List[int]) -> int:
+        """
+        Encodes pieces, appending ids and mask values. A token is trained on if its bytes overlap a trained span.
+        Returns the number of bytes consumed.
+        """
+        tokenizer = self.tokenizer
+        offset = 0
+        for _, piece, is_added_token in pieces:
+            word = piece.encode("utf-8")
+            ids = (tokenizer.convert_token_to_id(piece),) if is_added_token else tokenizer._encode_word(word)
+            input_ids.extend(ids)
+            piece_end = offset + len(word)
+            if not spans:
+                mask.extend([0] * len(ids))
+                offset = piece_end
+                continue
+            overlapping = [(begin, end) for begin, end in spans if begin < piece_end and offset < end]
+            if not overlapping or any(begin <= offset and piece_end <= end for begin, end in overlapping):
+                # the usual case: the whole piece is in or out of the trained text
+                mask.extend([1 if overlapping else 0] * len(ids))
+            else:
+                id_to_bytes = tokenizer.id_to_bytes # built on first use
+                for index in ids:
+                    token_end = offset + len(id_to_bytes[index]) if not is_added_token else piece_end
+                    mask.append(1 if any(begin < token_end and offset < end for begin, end in overlapping) else 0)
+                    offset = token_end
+            offset = piece_end
+        return offset
+
+    def encode_with_labels(self, messages: List[Dict[str, str]]) -> Dict[str, List[int]]:
+        """
+        HF-style inputs: `labels` copies the trained tokens and has `IGNORE_INDEX` everywhere else.
+        """
+        input_ids, mask = self.encode(messages)
+        return {"input_ids": input_ids, "labels": [index if keep else IGNORE_INDEX for index, keep in zip(input_ids, mask)]}
+
+
+def reference_mask(tokenizer: MySlowTokenizer, encoder: ChatEncoder, messages: List[Dict[str, str]], input_ids: List[int]) -> List[int]:
+    """
+    The mask computed the slow way, from the full rendered string and the byte offsets of every token.
+    """
+    spans, offset = [], 0
+    for message in messages:
+        for text, trained in encoder.render_message(message):
+            length = len(text.encode("utf-8"))
+            if trained and length:
+                spans.append((offset, offset + length))
+            offset += length
+    mask, offset = [], 0
+    for index in input_ids:
+        end = offset + len(tokenizer.convert_id_to_bytes(index))
+        mask.append(1 if any(begin < end and offset < span_end for begin, span_end in spans) else 0)
+        offset = end
+    return mask
+
+
+def make_conversations(num_conversations: int, seed: int) -> List[List[Dict[str, str]]]:
+    """
+    Conversations that share a few system prompts, and grow one turn at a time (like a chat session).
+    Contents include whitespace runs, punctuation and non-ASCII text at the boundaries.
+    """
+    rng = random.Random(seed)
+    words = ["Hello", "world", "  ", "\n\n", "don't", "42", "!!", "é", "🤗", "mango", " ", "\t", "[INST]", "<|im_end|>", "code:", "x=1"]
+    systems = [{"role": "system", "content": "You are a helpful assistant." * rng.randint(1, 20)} for _ in range(3)]
+    conversations = []
+    while len(conversations) < num_conversations:
+        messages = [rng.choice(systems)]
+        for turn in range(rng.randint(1, 6)):
+            role = "user" if turn % 2 == 0 else "assistant"
+            messages.append({"role": role, "content": "".join(rng.choice(words) + rng.choice(["", " "]) for _ in range(rng.randint(0, 30)))})
+            conversations.append(list(messages))
+    return conversations
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--vocab_file", type=str, default=os.path.join(HF_TOKENIZER_DIR, "vocab.json"))
+parser.add_argument("--template", type=str, default="chatml", choices=list(TEMPLATES))
+parser.add_argument("--num_conversations", type=int, default=200)
+parser.add_argument("--seed", type=int, default=0)
+
+if __name__ == "__main__":
+    # Checks that the ids match encoding the full rendered conversation, and that masks match `reference_mask`.
+    # Then compares the time taken with and without the prefix cache
+    args = parser.parse_args()
+    tokenizer = MySlowTokenizer(args.vocab_file)
+    encoder = ChatEncoder(tokenizer, args.template)
+    uncached_encoder = ChatEncoder(tokenizer, args.template, cache_size=0)
+    conversations = make_conversations(args.num_conversations, args.seed)
+    tokenizer.encode(encoder.render(conversations[0])) # build lazy tables outside of the timed region
+    tokenizer.id_to_bytes
+    timings = {}
+    for name, chat_encoder in [("no prefix cache", uncached_encoder), ("prefix cache", encoder)]:
+        tokenizer.cache.clear() # both start with a cold word cache
+        start = time.perf_counter()
+        outputs = [chat_encoder.encode(messages) for messages in conversations]
+        timings[name] = time.perf_counter() - start
+        for messages, (input_ids, mask) in zip(conversations, outputs):
+            assert input_ids == tokenizer.encode(encoder.render(messages)), f"ids differ from the full encoding for {messages}"
+            assert mask == reference_mask(tokenizer, encoder, messages, input_ids), f"wrong mask for {messages}"
+    num_tokens = sum(len(input_ids) for input_ids, _ in outputs)
+    print(f"{len(conversations)} conversations, {num_tokens} tokens: ids and masks match the full encoding")
+    for name, seconds in timings.items():
+        print(f"{name:>16}: {seconds:.3f}s ({num_tokens / seconds / 1e3:.0f}k tokens/s)")
+    print(f"Prefix cache: {encoder.cache}")